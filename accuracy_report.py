@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import numpy as np
+from makeplot import parse_stats
+from monitoring_loader import make_table, rb_counterpart
+from stats_output import read_records
+
+# Перцентили абсолютной ошибки в отчёте
+PERCENTILES = (50, 90, 95, 99)
+# Значения psutil по модулю меньше этого порога не участвуют в расчёте относительной ошибки
+RELATIVE_EPSILON = 1e-9
+
+
+# Пары (показатель psutil, показатель RuBackup), которые есть в статистике и являются числовыми
+def metric_pairs(statistics):
+    pairs = []
+    for name, values in statistics.items():
+        if not name.startswith("psutil_") or values.dtype != np.float64:
+            continue
+        rb_name = rb_counterpart(name)
+        if rb_name in statistics and statistics[rb_name].dtype == np.float64:
+            pairs.append((name, rb_name))
+    return pairs
+
+
+# Загрузка записей за период из текстового файла statistics (через кэш makeplot.parse_stats)
+# или из файла JSON Lines, записанного monitoring_test.py --output. Возвращает словарь колонок numpy
+def load_statistics(path, use_cache=True):
+    with open(path, "rb") as statistics_file:
+        jsonl = statistics_file.read(1) == b"{"
+    if not jsonl:
+        return parse_stats(path, use_cache)
+    rows = {}
+    keys = {}
+    for record, _ in read_records(path):
+        if record["type"] == "period":
+            rows[record["timestamp"]] = record["stats"]
+            keys[record["timestamp"]] = record["key"]
+    statistics = make_table(rows)
+    statistics["key"] = np.array([keys[timestamp] for timestamp in statistics["timestamp"].tolist()], dtype=str)
+    return statistics
+
+
+# Подписи записей для списка худших периодов: ключ записи (имя файла мониторинга), время timestamp_after
+# или номер записи
+def record_labels(statistics):
+    for name in ("key", "timestamp_after"):
+        if name in statistics:
+            return statistics[name]
+    return None
+
+
+# Статистика ошибки RuBackup относительно psutil по всем записям, где есть оба значения.
+# Ошибка - rb - psutil, относительная ошибка - |rb - psutil| / |psutil| в процентах.
+# Худшие worst записей по абсолютной ошибке выбираются через argpartition без полной сортировки
+def error_stats(psutil_values, rb_values, worst=5):
+    valid = ~(np.isnan(psutil_values) | np.isnan(rb_values))
+    indexes = np.flatnonzero(valid)
+    if not len(indexes):
+        return {"count": 0}
+    reference = psutil_values[indexes]
+    error = rb_values[indexes] - reference
+    absolute = np.abs(error)
+    nonzero = np.abs(reference) > RELATIVE_EPSILON
+    relative = absolute[nonzero] / np.abs(reference[nonzero]) * 100
+    stats = {
+        "count": int(len(indexes)),
+        "bias": float(error.mean()),
+        "mae": float(absolute.mean()),
+        "rmse": float(np.sqrt(np.mean(error * error))),
+        "max": float(absolute.max()),
+        "mean_relative_%": float(relative.mean()) if len(relative) else None,
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(absolute, PERCENTILES)):
+        stats[f"p{percentile}"] = float(value)
+    if len(relative):
+        stats["p95_relative_%"] = float(np.percentile(relative, 95))
+    worst = min(worst, len(absolute))
+    if worst:
+        top = np.argpartition(absolute, len(absolute) - worst)[-worst:]
+        top = top[np.argsort(absolute[top])[::-1]]
+        stats["worst"] = [
+            {
+                "record": int(indexes[i]),
+                "psutil": float(reference[i]),
+                "rb": float(rb_values[indexes[i]]),
+                "error": float(error[i]),
+            }
+            for i in top
+        ]
+    return stats
+
+
+# Отчёт о точности мониторинга RuBackup: статистика ошибки для каждой пары показателей.
+# Первые skip записей пропускаются - они посчитаны по неполному окну в начале сбора
+def accuracy_report(statistics, worst=5, skip=1):
+    labels = record_labels(statistics)
+    report = {}
+    for name, rb_name in metric_pairs(statistics):
+        stats = error_stats(statistics[name][skip:], statistics[rb_name][skip:], worst)
+        for record in stats.get("worst", ()):
+            record["record"] += skip
+            if labels is not None:
+                record["label"] = str(labels[record["record"]])
+        report[f"{name} / {rb_name}"] = stats
+    return report
+
+
+# Отчёт в виде таблицы: строка на пару показателей, под ней - худшие записи
+def format_report(report):
+    columns = ("count", "bias", "mae", "rmse", "mean_relative_%", *(f"p{p}" for p in PERCENTILES), "max")
+    width = max((len(pair) for pair in report), default=10)
+    lines = [f"{'показатели':<{width}} " + " ".join(f"{column:>15}" for column in columns)]
+    for pair, stats in report.items():
+        cells = []
+        for column in columns:
+            value = stats.get(column)
+            if value is None:
+                cells.append(f"{'-':>15}")
+            elif isinstance(value, int):
+                cells.append(f"{value:>15}")
+            else:
+                cells.append(f"{value:>15.4f}")
+        lines.append(f"{pair:<{width}} " + " ".join(cells))
+        for record in stats.get("worst", ()):
+            lines.append(
+                f"    запись {record['record']} {record.get('label', '')}: psutil {record['psutil']:.4f}, "
+                f"rb {record['rb']:.4f}, ошибка {record['error']:+.4f}"
+            )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Точность мониторинга RuBackup: сравнение показателей rb_* с показателями psutil_*"
+    )
+    parser.add_argument(
+        "statistics", nargs="?", default="statistics", help="файл statistics или JSON Lines (по умолчанию statistics)"
+    )
+    parser.add_argument("--worst", type=int, default=5, help="количество худших записей для каждой пары показателей")
+    parser.add_argument(
+        "--skip", type=int, default=1, help="количество первых записей, которые не учитываются (по умолчанию 1)"
+    )
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш разобранного файла")
+    args = parser.parse_args()
+
+    report = accuracy_report(load_statistics(args.statistics, not args.no_cache), args.worst, args.skip)
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print(format_report(report))
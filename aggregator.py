@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import stat
+import time
+import zlib
+from accuracy_report import accuracy_report, format_report
+from fleet import (
+    FRAME_HEADER,
+    HELLO,
+    MAX_FRAME,
+    PERIODS,
+    SAMPLES,
+    decode_periods,
+    decode_samples,
+    encode_ack,
+    parse_address,
+)
+from monitoring_loader import make_table
+from stats_output import JsonlWriter
+from stats_store import StatsStore
+
+
+# Данные одного узла: статистика за такт в хранилище фиксированного размера, последние записи за период
+# и номер последней принятой пачки текущего запуска агента, по которому отбрасываются повторно переданные пачки
+class HostState:
+    def __init__(self, host):
+        self.host = host
+        self.session = None
+        self.hello = {}
+        self.samples = None
+        self.periods = {}
+        self.last_sequence = 0
+        self.connection = None
+        self.received = 0
+        self.last_seen = None
+
+
+# Приём статистики от агентов monitoring_test.py --fleet. Каждое соединение обслуживается в цикле событий
+# asyncio, поэтому сотни агентов обрабатываются одним потоком: пачка статистики за такт разбирается
+# через numpy и добавляется в хранилище узла одним вызовом extend.
+# Подтверждение пачки отправляется после её сохранения, а следующий кадр читается только после
+# отправки подтверждения (drain). Если агрегатор не успевает, агенты ждут подтверждений и копят пачки у себя
+class Aggregator:
+    def __init__(self, capacity, periods_capacity, output=None):
+        self.capacity = capacity
+        self.periods_capacity = periods_capacity
+        self.output = output
+        self.hosts = {}
+        self.received = 0
+        # Открытые соединения по задачам, которые их обслуживают
+        self.connections = {}
+
+    async def handle(self, reader, writer):
+        state = None
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            kind, payload = await read_frame(reader)
+            if kind != HELLO:
+                return
+            state = self._register(json.loads(payload), writer)
+            writer.write(encode_ack(state.last_sequence))
+            await writer.drain()
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind == SAMPLES:
+                    self._store_samples(state, payload)
+                elif kind == PERIODS:
+                    self._store_periods(state, payload)
+                else:
+                    raise ValueError(f"неизвестный вид кадра {kind}")
+                state.last_seen = time.time()
+                writer.write(encode_ack(state.last_sequence))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError, zlib.error) as e:
+            if state is not None and not isinstance(e, (asyncio.IncompleteReadError, ConnectionError)):
+                print(f"Узел {state.host}: ошибка протокола ({e}), соединение закрыто")
+        finally:
+            if state is not None and state.connection is writer:
+                state.connection = None
+            del self.connections[task]
+            writer.close()
+
+    # Закрытие всех соединений с ожиданием завершения их обработки
+    async def close(self):
+        for writer in list(self.connections.values()):
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    # Регистрация соединения узла. Новый запуск агента начинает нумерацию пачек заново.
+    # Если у узла уже есть соединение (например, обрыв ещё не обнаружен), старое соединение закрывается
+    def _register(self, hello, writer):
+        state = self.hosts.get(hello["host"])
+        if state is None:
+            state = self.hosts[hello["host"]] = HostState(hello["host"])
+        if hello["session"] != state.session:
+            state.session = hello["session"]
+            state.last_sequence = 0
+        columns = tuple(hello["columns"])
+        if state.samples is None or state.samples.columns != columns:
+            state.samples = StatsStore(columns, self.capacity)
+        state.hello = hello
+        if state.connection is not None:
+            state.connection.close()
+        state.connection = writer
+        state.last_seen = time.time()
+        return state
+
+    def _store_samples(self, state, payload):
+        sequence, timestamps, values = decode_samples(payload, len(state.samples.columns))
+        if sequence <= state.last_sequence:
+            return
+        state.samples.extend(timestamps, {column: values[:, i] for i, column in enumerate(state.samples.columns)})
+        state.last_sequence = sequence
+        state.received += len(timestamps)
+        self.received += len(timestamps)
+
+    def _store_periods(self, state, payload):
+        sequence, records = decode_periods(payload)
+        if sequence <= state.last_sequence:
+            return
+        for timestamp, key, stats in records:
+            state.periods[timestamp] = (key, stats)
+            if self.output is not None:
+                self.output.write("period", timestamp, {"host": state.host, "key": key, "stats": stats})
+        # Хранятся последние periods_capacity записей за период (словарь упорядочен по добавлению)
+        while len(state.periods) > self.periods_capacity:
+            del state.periods[next(iter(state.periods))]
+        state.last_sequence = sequence
+
+    # Снимок записей за период для отчёта: (узел, [(метка времени, ключ, статистика), ...]).
+    # Снимок делается в цикле событий, а отчёт по нему может считаться в отдельном потоке
+    def snapshot(self):
+        return [
+            (host, sorted((timestamp, *record) for timestamp, record in state.periods.items()))
+            for host, state in self.hosts.items()
+        ]
+
+    # Состояние узлов: подключён ли агент, сколько принято тактов, время последнего такта
+    def status(self):
+        status = {}
+        for host, state in self.hosts.items():
+            samples = state.samples
+            status[host] = {
+                "connected": state.connection is not None,
+                "samples": state.received,
+                "periods": len(state.periods),
+                "last_timestamp": samples.timestamp() if samples is not None and samples.total else None,
+                "last_seen": state.last_seen,
+            }
+        return status
+
+
+async def read_frame(reader):
+    kind, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError(f"кадр размером {length} байт")
+    return kind, await reader.readexactly(length)
+
+
+# Таблица записей за период нескольких узлов для accuracy_report. Первые skip записей каждого узла
+# пропускаются - они посчитаны по неполному окну в начале сбора. Ключ записи - "узел ключ"
+def fleet_table(snapshot, skip=1):
+    rows = {}
+    for host, records in snapshot:
+        for _, key, stats in records[skip:]:
+            rows[len(rows)] = {**stats, "key": f"{host} {key}"}
+    return make_table(rows)
+
+
+# Сравнение показателей RuBackup с psutil по каждому узлу и по всем узлам вместе
+def fleet_report(snapshot, worst=5, skip=1):
+    return {
+        "hosts": {host: accuracy_report(fleet_table([(host, records)], skip), worst, 0) for host, records in snapshot},
+        "fleet": accuracy_report(fleet_table(snapshot, skip), worst, 0),
+    }
+
+
+def write_report(path, report, status):
+    with open(f"{path}.tmp", "w", encoding="utf-8") as report_file:
+        json.dump({"status": status, **report}, report_file, indent=2, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+async def serve(args, address):
+    output = JsonlWriter(args.output, args.batch_size, args.flush_interval) if args.output else None
+    aggregator = Aggregator(args.retention, args.periods, output)
+    family, location = address
+    if family == "unix":
+        # Сокет, оставшийся от прошлого запуска, удаляется. Другие файлы по этому пути не трогаются
+        if os.path.exists(location) and stat.S_ISSOCK(os.stat(location).st_mode):
+            os.remove(location)
+        server = await asyncio.start_unix_server(aggregator.handle, location, backlog=1024)
+    else:
+        server = await asyncio.start_server(aggregator.handle, *location, backlog=1024)
+    print(f"Приём статистики на {args.listen}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    received = 0
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), args.report_interval)
+            except asyncio.TimeoutError:
+                pass
+            status = aggregator.status()
+            connected = sum(host["connected"] for host in status.values())
+            print(
+                f"Узлов: {len(status)}, подключено: {connected}, "
+                f"тактов в секунду: {(aggregator.received - received) / args.report_interval:.1f}"
+            )
+            received = aggregator.received
+            if args.report:
+                report = await asyncio.to_thread(fleet_report, aggregator.snapshot(), args.worst, args.skip)
+                write_report(args.report, report, status)
+    finally:
+        server.close()
+        await aggregator.close()
+        await server.wait_closed()
+        if output is not None:
+            output.close()
+        if family == "unix" and os.path.exists(location):
+            os.remove(location)
+    return aggregator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Агрегатор статистики с нескольких узлов, на которых запущен monitoring_test.py --fleet"
+    )
+    parser.add_argument("listen", help="адрес для приёма статистики: хост:порт или unix:/путь")
+    parser.add_argument(
+        "--retention",
+        type=int,
+        default=600,
+        help="сколько тактов каждого узла хранить в памяти (по умолчанию %(default)s)",
+    )
+    parser.add_argument(
+        "--periods",
+        type=int,
+        default=1440,
+        help="сколько записей за период каждого узла хранить для отчёта (по умолчанию %(default)s)",
+    )
+    parser.add_argument("--output", help="файл JSON Lines, в который дописываются записи за период всех узлов")
+    parser.add_argument("--batch-size", type=int, default=64, help="размер пачки записей для --output")
+    parser.add_argument("--flush-interval", type=float, default=1.0, help="интервал сброса записей --output, с")
+    parser.add_argument("--report", help="файл JSON, в котором обновляется отчёт о точности мониторинга по узлам")
+    parser.add_argument(
+        "--report-interval", type=float, default=60.0, help="интервал вывода состояния и обновления --report, с"
+    )
+    parser.add_argument("--worst", type=int, default=5, help="количество худших записей для каждой пары показателей")
+    parser.add_argument("--skip", type=int, default=1, help="количество первых записей каждого узла, не учитываемых")
+    args = parser.parse_args()
+    try:
+        address = parse_address(args.listen)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.retention < 1 or args.periods < 1 or args.report_interval <= 0:
+        parser.error("--retention, --periods и --report-interval должны быть больше 0")
+
+    aggregator = asyncio.run(serve(args, address))
+    snapshot = aggregator.snapshot()
+    report = fleet_report(snapshot, args.worst, args.skip)
+    if args.report:
+        write_report(args.report, report, aggregator.status())
+    print(f"\nПринято тактов: {aggregator.received} от {len(snapshot)} узлов")
+    for host, host_report in report["hosts"].items():
+        print(f"\nУзел {host}:")
+        print(format_report(host_report))
+    print("\nВсе узлы:")
+    print(format_report(report["fleet"]))
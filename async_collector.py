@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+
+# Вызов функции с замером момента снимка: середина интервала вызова по монотонным часам
+def timed_call(function, *args):
+    start = monotonic()
+    result = function(*args)
+    return result, (start + monotonic()) / 2
+
+
+# Расхождение во времени между снимком общесистемной статистики и снимками процессов, в секундах
+def snapshot_skew(general_time, target_times):
+    return max((abs(target_time - general_time) for target_time in target_times), default=0.0)
+
+
+# Сбор статистики за такт на asyncio. Снимок общесистемной статистики, снимки процессов всех целей
+# и обработка файлов мониторинга запускаются одновременно: блокирующие вызовы psutil и чтение файлов
+# выполняются в пуле потоков, а цикл событий только дожидается их завершения.
+# Поэтому снимки системы и процессов делаются практически в один момент, и медленный обход дерева
+# процессов не сдвигает снимок процессов относительно снимка системы.
+class AsyncCollector:
+    def __init__(self, read_general, read_targets, ingest=None):
+        self._read_general = read_general
+        self._read_targets = list(read_targets)
+        self._ingest = ingest
+        self._pool = ThreadPoolExecutor(len(self._read_targets) + 2)
+
+    # Возвращает (счётчики системы, момент снимка), [(суммы по цели, момент снимка), ...]
+    async def snapshot(self):
+        loop = asyncio.get_running_loop()
+        general = loop.run_in_executor(self._pool, timed_call, self._read_general)
+        targets = [loop.run_in_executor(self._pool, timed_call, read_target) for read_target in self._read_targets]
+        tasks = [general, *targets]
+        if self._ingest is not None:
+            tasks.append(loop.run_in_executor(self._pool, self._ingest))
+        results = await asyncio.gather(*tasks)
+        return results[0], results[1 : 1 + len(targets)]
+
+    def close(self):
+        self._pool.shutdown()
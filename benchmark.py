@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from monitoring_loader import RB_TIMESTAMP_FORMAT, TIMESTAMP_FORMAT, parse_monitoring_data
+from period_aggregator import PERIOD_COLUMNS
+from stats_output import StatisticsWriter
+
+MONITORING_TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitoring_test.py")
+# Синтетические процессы получают pid больше максимально возможного в Linux, чтобы не совпасть с настоящими
+FIRST_PID = 5000000
+# Количество дочерних процессов у каждого процесса синтетического дерева
+FANOUT = 4
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+BOOT_TIME = 1700000000
+# Хранилища в bench_gather_period_stats заполняются частями по столько записей
+FILL_CHUNK = 10**6
+# Показатели в файлах мониторинга RuBackup
+MONITORING_FIELDS = (
+    "general_cpu_usage",
+    "general_net_usage_r",
+    "general_net_usage_w",
+    "general_io_usage_r",
+    "general_io_usage_w",
+    "general_ram_usage",
+    "general_ram_usage_m",
+    "client_cpu_usage",
+    "client_io_usage_r",
+    "client_io_usage_w",
+    "client_ram_usage",
+    "client_ram_usage_m",
+)
+
+
+# Имя синтетического диска: sda, sdb, ..., sdz, sdaa, ... (подходит под шаблон дисков в monitoring_test.py)
+def disk_name(index):
+    name = ""
+    index += 1
+    while index:
+        index, letter = divmod(index - 1, 26)
+        name = chr(ord("a") + letter) + name
+    return "sd" + name
+
+
+# Синтетическая файловая система proc: дерево из processes процессов (корень - rubackup_client,
+# у каждого процесса до FANOUT дочерних) и disks дисков. Файлы в том же формате, что и в /proc,
+# поэтому их читают и psutil (через psutil.PROCFS_PATH), и ProcReader.
+# Если children_files=True, создаются и файлы /proc/<pid>/task/<pid>/children, как в ядрах с
+# CONFIG_PROC_CHILDREN, иначе дочерние процессы ищутся через psutil.
+# advance() увеличивает все счётчики так, как будто прошёл один такт
+class FakeProc:
+    def __init__(self, path, processes, disks, children_files=True):
+        self.path = path
+        self.pids = [FIRST_PID + i for i in range(processes)]
+        self.disks = [disk_name(i) for i in range(disks)]
+        self.ticks = 0
+        os.makedirs(f"{path}/net", exist_ok=True)
+        with open(f"{path}/meminfo", "w") as meminfo:
+            meminfo.write(
+                "MemTotal: 16384000 kB\nMemFree: 8192000 kB\nMemAvailable: 10240000 kB\nBuffers: 0 kB\n"
+                "Cached: 0 kB\nShmem: 0 kB\nActive: 0 kB\nInactive: 0 kB\nSReclaimable: 0 kB\n"
+            )
+        processes = [(pid, "rubackup_client" if i == 0 else "rb_worker") for i, pid in enumerate(self.pids)]
+        self._names = dict(processes)
+        self._parents = {pid: 1 for pid in self._names}
+        children = {pid: [] for pid in self._names}
+        for i, pid in enumerate(self.pids[1:], 1):
+            self._parents[pid] = self.pids[(i - 1) // FANOUT]
+            children[self._parents[pid]].append(pid)
+        for pid, name in processes:
+            os.makedirs(f"{path}/{pid}/task/{pid}", exist_ok=True)
+            for file_name, text in (("comm", f"{name}\n"), ("cmdline", f"{name}\0"), ("status", f"Name:\t{name}\n")):
+                with open(f"{path}/{pid}/{file_name}", "w") as proc_file:
+                    proc_file.write(text)
+            if children_files:
+                with open(f"{path}/{pid}/task/{pid}/children", "w") as children_file:
+                    children_file.write(" ".join(map(str, children[pid])))
+        self.advance()
+
+    def _write(self, name, text):
+        with open(f"{self.path}/{name}", "w") as proc_file:
+            proc_file.write(text)
+
+    def advance(self):
+        self.ticks += 1
+        ticks = self.ticks
+        cpu_count = os.cpu_count() or 1
+        busy = ticks * CLOCK_TICKS * cpu_count // 4
+        idle = ticks * CLOCK_TICKS * cpu_count - busy
+        self._write("stat", f"cpu  {busy} 0 0 {idle} 0 0 0 0 0 0\nbtime {BOOT_TIME}\n")
+        self._write(
+            "net/dev",
+            "Inter-|   Receive                                                |  Transmit\n"
+            " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo "
+            "colls carrier compressed\n"
+            f"  eth0: {ticks * 125000} {ticks * 100} 0 0 0 0 0 0 {ticks * 250000} {ticks * 200} 0 0 0 0 0 0\n",
+        )
+        self._write(
+            "diskstats",
+            "".join(
+                f"   8 {i * 16} {name} {ticks * 10} 0 {ticks * 2048} 0 {ticks * 20} 0 {ticks * 4096} 0 0 0 0\n"
+                for i, name in enumerate(self.disks)
+            ),
+        )
+        for i, (pid, name) in enumerate(self._names.items()):
+            fields = ["0"] * 52
+            fields[:4] = [str(pid), f"({name})", "S", str(self._parents[pid])]
+            # utime, stime и starttime - 14, 15 и 22 поля файла stat
+            fields[13] = str(ticks * (i % 3 + 1))
+            fields[14] = str(ticks)
+            fields[21] = str(100 + i)
+            self._write(f"{pid}/stat", " ".join(fields) + "\n")
+            self._write(
+                f"{pid}/io",
+                f"rchar: 0\nwchar: 0\nsyscr: 0\nsyscw: 0\nread_bytes: {ticks * 4096 * (i % 5)}\n"
+                f"write_bytes: {ticks * 8192 * (i % 2)}\ncancelled_write_bytes: 0\n",
+            )
+            self._write(f"{pid}/statm", f"{2048 + i} {256 + i % 64} 0 0 0 0 0\n")
+
+
+# Синтетическая директория мониторинга RuBackup: файлы за count периодов по period секунд,
+# начиная со start_ms (миллисекунды epoch). Значения - строки, как в настоящих файлах.
+# Окно каждого файла (timestamp_before - timestamp_after) - period секунд до времени из имени файла,
+# сдвинутое на доли секунды относительно тактов сбора
+def make_monitoring_dir(path, start_ms, count, period):
+    os.makedirs(path, exist_ok=True)
+    random = np.random.default_rng(0)
+    values = random.uniform(0, 100, (count, len(MONITORING_FIELDS)))
+    for i in range(count):
+        moment = datetime.fromtimestamp((start_ms + (i + 1) * period * 1000) / 1000)
+        data = {"hwid": "1234567890", "hostname": "benchmark"}
+        data.update((name, f"{value:.6f}") for name, value in zip(MONITORING_FIELDS, values[i]))
+        window_start = datetime.fromtimestamp(moment.timestamp() - period)
+        data["timestamp_before"] = window_start.strftime(RB_TIMESTAMP_FORMAT) + ":250"
+        data["timestamp_after"] = moment.strftime(RB_TIMESTAMP_FORMAT) + ":250"
+        with open(os.path.join(path, moment.strftime(TIMESTAMP_FORMAT)), "w") as monitoring_file:
+            json.dump(data, monitoring_file)
+
+
+# Синтетический файл statistics из records записей за период в формате monitoring_test.py
+def make_statistics_file(path, records, start_ms):
+    random = np.random.default_rng(0)
+    names = list(PERIOD_COLUMNS) + list(parse_monitoring_data(dict.fromkeys(MONITORING_FIELDS, "0")))
+    values = random.uniform(0, 100, (records, len(names)))
+    writer = StatisticsWriter(path, batch_size=1024)
+    for i in range(records):
+        timestamp = start_ms + i * 1000
+        moment = datetime.fromtimestamp(timestamp / 1000)
+        stats = dict(zip(names, values[i].tolist()))
+        stats["rb_hwid"] = "1234567890"
+        stats["rb_timestamp_after"] = moment.strftime(RB_TIMESTAMP_FORMAT) + ":900"
+        writer.write("period", timestamp, {"key": moment.strftime(TIMESTAMP_FORMAT), "stats": stats})
+    writer.close()
+
+
+# Загрузка monitoring_test.py как модуля с указанными аргументами командной строки.
+# Каждый вызов создаёт новый экземпляр модуля со своими хранилищами; сбор при импорте не запускается
+def load_collector(argv):
+    spec = importlib.util.spec_from_file_location("monitoring_test", MONITORING_TEST)
+    collector = importlib.util.module_from_spec(spec)
+    saved_argv = sys.argv
+    sys.argv = [MONITORING_TEST, *argv]
+    try:
+        spec.loader.exec_module(collector)
+    finally:
+        sys.argv = saved_argv
+    return collector
+
+
+def close_collector(collector):
+    for writer in collector.output_writers:
+        writer.close()
+    for target in collector.client_targets:
+        target["target"].close()
+    if collector.targets_pool is not None:
+        collector.targets_pool.shutdown()
+
+
+# Сводка по времени тактов в миллисекундах
+def latency_summary(durations):
+    durations = np.array(durations) * 1000
+    return {
+        "mean_ms": float(durations.mean()),
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p95_ms": float(np.percentile(durations, 95)),
+        "p99_ms": float(np.percentile(durations, 99)),
+        "max_ms": float(durations.max()),
+    }
+
+
+# Время одного такта collect_stats на синтетической /proc из processes процессов и disks дисков.
+# Обновление синтетических файлов между тактами не входит в измерение
+def bench_collect_stats(workdir, backend, processes, disks, ticks, children_files):
+    proc_path = os.path.join(workdir, f"proc_{backend}_{processes}_{disks}")
+    fake_proc = FakeProc(proc_path, processes, disks, children_files)
+    collector = load_collector(
+        [
+            "1",
+            str(ticks + 1),
+            "--watch",
+            "off",
+            "--backend",
+            backend,
+            "--proc-path",
+            proc_path,
+            "--monitoring-dir",
+            os.path.join(workdir, "monitoring_empty"),
+            "--statistics",
+            os.path.join(workdir, "statistics_collect"),
+        ]
+    )
+    timestamp = int(time.time()) * 1000
+    durations = []
+    cpu_start = time.process_time()
+    try:
+        # Первый такт только заполняет счётчики и кэши и не учитывается
+        for tick in range(ticks + 1):
+            fake_proc.advance()
+            start = time.perf_counter()
+            collector.collect_stats(timestamp + tick * 1000)
+            if tick:
+                durations.append(time.perf_counter() - start)
+        tracked = len(collector.client_targets[0]["target"].tree)
+    finally:
+        close_collector(collector)
+    return {
+        "name": "collect_stats",
+        "params": {
+            "backend": backend,
+            "processes": processes,
+            "disks": disks,
+            "ticks": ticks,
+            "children_files": children_files,
+        },
+        "metrics": {
+            **latency_summary(durations),
+            "cpu_ms_per_tick": (time.process_time() - cpu_start) * 1000 / (ticks + 1),
+            "tracked_processes": tracked,
+        },
+    }
+
+
+# Заполнение хранилища синтетическими записями частями по FILL_CHUNK: values(column, indexes) возвращает
+# значения колонки для номеров записей, поэтому в памяти кроме хранилища только одна часть значений
+def fill_store(store, timestamps, values):
+    for start in range(0, len(timestamps), FILL_CHUNK):
+        indexes = np.arange(start, min(start + FILL_CHUNK, len(timestamps)))
+        store.extend(timestamps[indexes], {column: values(column, indexes) for column in store.columns})
+
+
+# Стоимость gather_period_stats в конце сбора (--watch off) для samples тактов сбора.
+# Хранилища накопленных счётчиков и значений тактов для пиков заполняются синтетическими значениями
+# за каждый такт, файлы мониторинга создаются за каждый период. Записи за период заполняются только
+# на секундах из имён файлов: сопоставление читает только их, а хранилище на 61 колонку за каждый такт
+# заняло бы около 5 ГБ при 10^7 тактов. Заполненные хранилища занимают около 270 байт на такт, их память
+# выделяется при первой записи: при 10^7 тактов процесс вместе с сопоставлением занимает около 3,3 ГБ.
+# Первый вызов - с пустым кэшем файлов мониторинга, второй - с заполненным
+def bench_gather_period_stats(workdir, samples, period):
+    start_ms = (int(time.time()) - samples) * 1000
+    monitoring_dir = os.path.join(workdir, f"monitoring_{samples}_{period}")
+    files = samples // period
+    if not os.path.isdir(monitoring_dir):
+        make_monitoring_dir(monitoring_dir, start_ms, files, period)
+    cache = os.path.join(workdir, f"monitoring_{samples}_{period}.sqlite")
+    fake_proc = FakeProc(os.path.join(workdir, "proc_gather"), 1, 1)
+    # Хранилища рассчитываются на один период больше, чтобы samples + 1 накопленных счётчиков поместились
+    # без перезаписи: иначе каждое чтение колонки склеивает кольцевой буфер в новый массив
+    collector = load_collector(
+        [
+            str(period),
+            str(files + 1),
+            "--watch",
+            "off",
+            "--proc-path",
+            fake_proc.path,
+            "--monitoring-dir",
+            monitoring_dir,
+            "--monitoring-cache",
+            cache,
+            "--statistics",
+            os.path.join(workdir, "statistics_gather"),
+        ]
+    )
+    try:
+        random = np.random.default_rng(0)
+        file_timestamps = start_ms + np.arange(1, files + 1, dtype=np.int64) * period * 1000
+
+        def uniform(column, indexes):
+            return np.ones(len(indexes)) if column == "elapsed" else random.uniform(0, 100, len(indexes))
+
+        fill_store(collector.period_records, file_timestamps, uniform)
+        fill_store(collector.tick_peaks, start_ms + np.arange(1, samples + 1, dtype=np.int64) * 1000, uniform)
+        # Накопленные счётчики растут в среднем на 5 за такт
+        counters = [collector.general_stats_counters, collector.self_target["counters"]]
+        counters.extend(target["counters"] for target in collector.client_targets)
+        for store in counters:
+            fill_store(
+                store,
+                start_ms + np.arange(samples + 1, dtype=np.int64) * 1000,
+                lambda column, indexes: indexes * 5.0 + random.uniform(0, 5, len(indexes)),
+            )
+        timings = {}
+        for run in ("cold", "warm"):
+            start = time.perf_counter()
+            collector.gather_period_stats()
+            timings[f"{run}_s"] = time.perf_counter() - start
+    finally:
+        close_collector(collector)
+    return {
+        "name": "gather_period_stats",
+        "params": {"samples": samples, "period": period, "files": files},
+        "metrics": {**timings, "warm_files_per_s": files / timings["warm_s"] if timings["warm_s"] else None},
+    }
+
+
+# Скорость разбора файла statistics в makeplot.parse_stats: без кэша, с созданием кэша и с загрузкой из кэша
+def bench_parse_stats(workdir, records):
+    import makeplot
+
+    path = os.path.join(workdir, f"statistics_{records}")
+    if not os.path.exists(path):
+        make_statistics_file(path, records, (int(time.time()) - records) * 1000)
+    makeplot.CACHE_DIR = os.path.join(workdir, "plot_cache")
+    size = os.path.getsize(path)
+    timings = {}
+    for run, use_cache in (("parse", False), ("cache_write", True), ("cache_read", True)):
+        start = time.perf_counter()
+        makeplot.parse_stats(path, use_cache)
+        timings[f"{run}_s"] = time.perf_counter() - start
+    return {
+        "name": "parse_stats",
+        "params": {"records": records},
+        "metrics": {
+            **timings,
+            "bytes": size,
+            "parse_mb_per_s": size / timings["parse_s"] / 1e6,
+            "parse_records_per_s": records / timings["parse_s"],
+        },
+    }
+
+
+# Версия кода, для которой получены результаты
+def code_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(MONITORING_TEST),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Сравнение результатов с результатами предыдущего запуска: отношение новых значений к старым
+# для одинаковых бенчмарков с одинаковыми параметрами
+def compare_results(results, baseline):
+    previous = {(result["name"], json.dumps(result["params"], sort_keys=True)): result for result in baseline}
+    for result in results:
+        old = previous.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if old is None:
+            continue
+        ratios = []
+        for metric, value in result["metrics"].items():
+            old_value = old["metrics"].get(metric)
+            if isinstance(value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+                ratios.append(f"{metric} x{value / old_value:.2f}")
+        print(f"{result['name']} {result['params']}: {', '.join(ratios)}", file=sys.stderr)
+
+
+def parse_sizes(text):
+    return [int(float(size)) for size in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Бенчмарки сборщика статистики на синтетической /proc и синтетических файлах мониторинга"
+    )
+    parser.add_argument(
+        "--only",
+        choices=("collect", "gather", "parse"),
+        action="append",
+        help="запустить только указанные бенчмарки (можно указать несколько раз)",
+    )
+    parser.add_argument(
+        "--backend", choices=("psutil", "proc"), action="append", help="способ сбора (по умолчанию оба)"
+    )
+    parser.add_argument("--processes", type=parse_sizes, default=[10, 100, 1000], help="количество процессов цели")
+    parser.add_argument("--disks", type=parse_sizes, default=[4], help="количество дисков")
+    parser.add_argument("--ticks", type=int, default=50, help="количество измеряемых тактов")
+    parser.add_argument(
+        "--no-children-files",
+        action="store_true",
+        help="не создавать файлы /proc/<pid>/task/<pid>/children (поиск дочерних процессов через psutil)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=parse_sizes,
+        default=[10**3, 10**4, 10**5, 10**6],
+        help="количество тактов сбора для gather_period_stats, через запятую (например 1e3,1e7; "
+        "при 1e7 нужно около 3,5 ГБ памяти)",
+    )
+    parser.add_argument("--period", type=int, default=60, help="период мониторинга для gather_period_stats")
+    parser.add_argument(
+        "--records", type=parse_sizes, default=[10**3, 10**4, 10**5], help="количество записей для parse_stats"
+    )
+    parser.add_argument("--workdir", help="директория для синтетических файлов (по умолчанию временная)")
+    parser.add_argument("--output", help="файл для результатов в JSON (по умолчанию stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="сравнить с результатами из файла предыдущего запуска")
+    args = parser.parse_args()
+
+    only = args.only or ("collect", "gather", "parse")
+    with tempfile.TemporaryDirectory(prefix="test_monitoring_bench_") as temp_dir:
+        workdir = args.workdir or temp_dir
+        os.makedirs(workdir, exist_ok=True)
+        results = []
+        if "collect" in only:
+            for backend in args.backend or ("psutil", "proc"):
+                for processes in args.processes:
+                    for disks in args.disks:
+                        print(f"collect_stats {backend} {processes} процессов, {disks} дисков", file=sys.stderr)
+                        results.append(
+                            bench_collect_stats(
+                                workdir, backend, processes, disks, args.ticks, not args.no_children_files
+                            )
+                        )
+        if "gather" in only:
+            for samples in args.samples:
+                print(f"gather_period_stats {samples} записей", file=sys.stderr)
+                results.append(bench_gather_period_stats(workdir, samples, args.period))
+        if "parse" in only:
+            for records in args.records:
+                print(f"parse_stats {records} записей", file=sys.stderr)
+                results.append(bench_parse_stats(workdir, records))
+
+    report = {
+        "version": code_version(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare_results(results, json.load(baseline)["results"])
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+import numpy as np
+
+# Виды кадров протокола агента и агрегатора. Кадр - заголовок (вид, длина данных) и данные.
+# Агент открывает соединение кадром HELLO с описанием узла и колонок статистики за такт, затем передаёт
+# пачки SAMPLES (статистика за такт) и PERIODS (записи за период). Каждая пачка имеет номер, агрегатор
+# отвечает кадром ACK с номером последней принятой пачки - все пачки с номером не больше него приняты
+HELLO, SAMPLES, PERIODS, ACK = 1, 2, 3, 4
+FRAME_HEADER = struct.Struct("!BI")
+SEQUENCE = struct.Struct("!Q")
+# Кадры больше этого размера считаются ошибкой протокола
+MAX_FRAME = 64 * 1024 * 1024
+# Пауза перед повторным подключением к агрегатору: удваивается после каждой неудачи до RECONNECT_MAX секунд
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+
+
+# Разбор адреса агрегатора: "unix:/путь/к/сокету" или "хост:порт" (IPv6-адрес - в квадратных скобках).
+# Возвращает ("unix", путь) или ("tcp", (хост, порт))
+def parse_address(text):
+    if text.startswith("unix:"):
+        if not text[len("unix:") :]:
+            raise ValueError(f"не указан путь к сокету в адресе {text!r}")
+        return "unix", text[len("unix:") :]
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"неверный адрес {text!r}: ожидается хост:порт или unix:/путь")
+    return "tcp", (host.strip("[]"), int(port))
+
+
+def encode_frame(kind, payload):
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def encode_ack(sequence):
+    return encode_frame(ACK, SEQUENCE.pack(sequence))
+
+
+# Пачка статистики за такт: метки времени int64 и строки значений float64 в порядке колонок из HELLO,
+# сжатые zlib. Строка из n колонок занимает 8 * (n + 1) байт до сжатия, имена колонок не передаются
+def encode_samples(sequence, timestamps, rows):
+    data = np.asarray(timestamps, dtype="<i8").tobytes() + np.asarray(rows, dtype="<f8").tobytes()
+    return encode_frame(SAMPLES, SEQUENCE.pack(sequence) + zlib.compress(data, 1))
+
+
+# Разбор пачки статистики за такт: номер пачки, массив меток времени и двумерный массив значений
+def decode_samples(payload, columns):
+    (sequence,) = SEQUENCE.unpack_from(payload)
+    data = zlib.decompress(payload[SEQUENCE.size :])
+    count, remainder = divmod(len(data), 8 * (columns + 1))
+    if remainder:
+        raise ValueError("размер пачки не соответствует количеству колонок")
+    timestamps = np.frombuffer(data, dtype="<i8", count=count)
+    values = np.frombuffer(data, dtype="<f8", offset=8 * count).reshape(count, columns)
+    return sequence, timestamps, values
+
+
+# Пачка записей за период: список [метка времени, ключ, статистика] в JSON, сжатый zlib.
+# Записи за период приходят раз в период и содержат строковые поля файла мониторинга, поэтому передаются как есть
+def encode_periods(sequence, records):
+    data = json.dumps(records, ensure_ascii=False).encode()
+    return encode_frame(PERIODS, SEQUENCE.pack(sequence) + zlib.compress(data, 1))
+
+
+def decode_periods(payload):
+    (sequence,) = SEQUENCE.unpack_from(payload)
+    return sequence, json.loads(zlib.decompress(payload[SEQUENCE.size :]))
+
+
+# Передача статистики агрегатору (aggregator.py) из monitoring_test.py --fleet.
+# Записи накапливаются в пачки так же, как в BatchedWriter: пачка закрывается, когда в ней batch_size записей
+# или с прошлого закрытия прошло flush_interval секунд. Закрытые пачки кодируются и ставятся в очередь,
+# а передаёт их отдельный поток, поэтому сбор никогда не ждёт сеть.
+# Пачка остаётся в очереди, пока агрегатор не подтвердит её приём. Без подтверждения передаётся
+# не больше window пачек: если агрегатор не успевает, передача приостанавливается и пачки копятся в очереди.
+# Очередь ограничена max_rows записями - при переполнении отбрасываются самые старые пачки (dropped).
+# При обрыве соединения поток подключается заново с нарастающей паузой и передаёт все неподтверждённые пачки.
+# Номер запуска (session) из HELLO вместе с номерами пачек позволяет агрегатору отбросить повторно
+# переданные пачки, а агенту - не передавать уже принятые
+class FleetSender:
+    def __init__(
+        self, address, hello, columns, batch_size=64, flush_interval=1.0, max_rows=3600, window=16, timeout=30.0
+    ):
+        self.address = address
+        self.columns = tuple(columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.window = window
+        self.timeout = timeout
+        self._hello = encode_frame(
+            HELLO, json.dumps({**hello, "session": uuid.uuid4().hex, "columns": self.columns}).encode()
+        )
+        self._timestamps = []
+        self._rows = []
+        self._periods = []
+        self._last_flush = time.monotonic()
+        self._sequence = 0
+        # Очередь закрытых пачек: [номер, количество записей, кадр]
+        self._pending = deque()
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+        # Уведомление о подтверждении пачек для close
+        self._acked_condition = threading.Condition(self._lock)
+        self._sent = 0
+        self._acked = 0
+        self._last_ack = 0.0
+        self._sock = None
+        self._buffer = b""
+        self._closing = False
+        # Пробуждение потока передачи при появлении новой пачки и при закрытии
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self.delivered = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._thread = threading.Thread(target=self._run, name="fleet", daemon=True)
+        self._thread.start()
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    @property
+    def pending_rows(self):
+        return self._pending_rows
+
+    # Статистика такта: значения в порядке columns
+    def add_sample(self, timestamp, values):
+        self._timestamps.append(timestamp)
+        self._rows.append(values)
+        self._maybe_flush()
+
+    # Интерфейс файлов результатов (см. BatchedWriter): агрегатору передаются только записи за период
+    def write(self, kind, timestamp, record):
+        if kind == "period":
+            self._periods.append([timestamp, record["key"], record["stats"]])
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (
+            len(self._timestamps) + len(self._periods) >= self.batch_size
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        batches = []
+        if self._timestamps:
+            self._sequence += 1
+            batches.append(
+                [self._sequence, len(self._rows), encode_samples(self._sequence, self._timestamps, self._rows)]
+            )
+            self._timestamps = []
+            self._rows = []
+        if self._periods:
+            self._sequence += 1
+            batches.append([self._sequence, len(self._periods), encode_periods(self._sequence, self._periods)])
+            self._periods = []
+        self._last_flush = time.monotonic()
+        if not batches:
+            return
+        with self._lock:
+            for batch in batches:
+                self._pending.append(batch)
+                self._pending_rows += batch[1]
+            while self._pending_rows > self.max_rows and len(self._pending) > 1:
+                _, rows, _ = self._pending.popleft()
+                self._pending_rows -= rows
+                self.dropped += rows
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_writer.send(b"\0")
+        except OSError:
+            pass
+
+    def _run(self):
+        delay = RECONNECT_MIN
+        while not self._closing:
+            if self._sock is None:
+                try:
+                    self._connect()
+                    delay = RECONNECT_MIN
+                except (OSError, ValueError):
+                    self._disconnect()
+                    # Случайная доля паузы, чтобы агенты не подключались одновременно после перезапуска агрегатора
+                    self._wait(delay * random.uniform(0.5, 1.0))
+                    delay = min(delay * 2, RECONNECT_MAX)
+                    continue
+            try:
+                self._send_window()
+                self._receive_acks()
+            except (OSError, ValueError):
+                self._disconnect()
+        self._disconnect()
+
+    def _connect(self):
+        family, address = self.address
+        if family == "unix":
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(address)
+        else:
+            self._sock = socket.create_connection(address, self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reconnects += 1
+        self._buffer = b""
+        self._sock.sendall(self._hello)
+        # В ответ на HELLO агрегатор сообщает номер последней пачки, которую он уже принял от этого запуска
+        while not self._read_acks():
+            pass
+        self._sent = self._acked
+        self._last_ack = time.monotonic()
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    # Ожидание новой пачки или закрытия, не дольше seconds секунд
+    def _wait(self, seconds):
+        select.select([self._wake_reader], [], [], seconds)
+        self._drain_wake()
+
+    def _drain_wake(self):
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    # Передача неподтверждённых пачек, не больше window пачек без подтверждения
+    def _send_window(self):
+        frames = []
+        with self._lock:
+            in_flight = 0
+            for sequence, _, frame in self._pending:
+                if sequence <= self._sent:
+                    in_flight += 1
+                elif in_flight + len(frames) < self.window:
+                    frames.append(frame)
+                    last = sequence
+                else:
+                    break
+        if frames:
+            self._sock.sendall(b"".join(frames))
+            self._sent = last
+
+    def _receive_acks(self):
+        readable, _, _ = select.select([self._sock, self._wake_reader], [], [], self.flush_interval)
+        if self._wake_reader in readable:
+            self._drain_wake()
+        if self._sock in readable:
+            self._read_acks()
+        elif self._sent > self._acked and time.monotonic() - self._last_ack > self.timeout:
+            raise TimeoutError("агрегатор не подтверждает приём пачек")
+
+    # Чтение подтверждений из соединения. Возвращает True, если получено хотя бы одно подтверждение
+    def _read_acks(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise ConnectionError("агрегатор закрыл соединение")
+        self._buffer += data
+        acked = None
+        while len(self._buffer) >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(self._buffer)
+            if kind != ACK or length != SEQUENCE.size:
+                raise ValueError("неверный кадр от агрегатора")
+            if len(self._buffer) < FRAME_HEADER.size + length:
+                break
+            (acked,) = SEQUENCE.unpack_from(self._buffer, FRAME_HEADER.size)
+            self._buffer = self._buffer[FRAME_HEADER.size + length :]
+        if acked is None:
+            return False
+        self._last_ack = time.monotonic()
+        with self._lock:
+            self._acked = max(self._acked, acked)
+            while self._pending and self._pending[0][0] <= self._acked:
+                _, rows, _ = self._pending.popleft()
+                self._pending_rows -= rows
+                self.delivered += rows
+            self._acked_condition.notify_all()
+        return True
+
+    # Закрытие с передачей накопленных записей: ожидание подтверждения всех пачек не дольше timeout секунд
+    def close(self, timeout=5.0):
+        self.flush()
+        with self._lock:
+            self._acked_condition.wait_for(lambda: not self._pending, timeout)
+        self._closing = True
+        self._wake()
+        # Поток может ждать в sendall, если агрегатор не принимает данные
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._thread.join()
+        self._wake_reader.close()
+        self._wake_writer.close()
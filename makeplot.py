@@ -1,56 +1,246 @@
 #!/usr/bin/env python3
 
-from statistics import mean
+import argparse
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import sys
-import matplotlib.pyplot as plt
+from period_aggregator import PEAK_KINDS
+
+# Директория для кэша разобранных файлов со статистикой
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "test_monitoring")
+
+
+# Группы параметров, для каждой из которых в пакетном режиме строится отдельный график
+PARAMETER_GROUPS = ("cpu", "io_usage_r", "io_usage_w", "net_usage_r", "net_usage_w", "ram_usage_%", "ram_usage_m")
+# Размер и разрешение графика. Длинные ряды прореживаются до ширины графика в пикселях
+FIGSIZE = (35, 10)
+DPI = 100
+# Количество подписей на оси абсцисс
+X_TICKS = 60
+
+
+# Путь до файла кэша для файла со статистикой: имя - хэш полного пути к файлу
+def cache_path(path):
+    return os.path.join(CACHE_DIR, hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + ".npz")
 
-statistics = {}
 
 # Парсинг данных из файла со статистикой. Ключи в словаре, это имена параметров.
-# Значения для ключей - это список значений этих параметров
-def parse_stats():
-    with open("/home/u/test_monitoring/statistics") as stats:
-        list_stats = stats.readlines()
-    for line in list_stats:
-        parsed_line = line.replace("\n", "").split()
-        if "timestamp_after" in line and "timestamp_after" not in statistics.keys():
-            statistics["timestamp_after"] = [parsed_line[-1]]
-        elif "timestamp_after" in line:
-            statistics["timestamp_after"].append(parsed_line[-1])
-        elif len(parsed_line) >= 2:
-            if parsed_line[0] not in statistics.keys():
-                statistics[parsed_line[0]] = [
-                    parsed_line[1],
-                ]
+# Значения для ключей - это массивы numpy со значениями этих параметров, по одному значению на запись
+# (блок между разделителями) в файле. Если в записи параметра нет, на его месте nan (или пустая строка).
+# Числовые параметры хранятся как float64, остальные (rb_hwid, rb_hostname) - как строки.
+# Файл читается построчно, а результат сохраняется в кэш вместе со временем изменения и размером файла,
+# поэтому повторный запуск для неизменившегося файла только загружает готовые массивы
+def parse_stats(path, use_cache=True):
+    file_stat = os.stat(path)
+    file_id = np.array([file_stat.st_mtime_ns, file_stat.st_size], dtype=np.int64)
+    cache_file = cache_path(path)
+    if use_cache:
+        try:
+            with np.load(cache_file, allow_pickle=False) as cache:
+                if np.array_equal(cache["__file_id__"], file_id):
+                    return {name: cache[name] for name in cache.files if name != "__file_id__"}
+        except (OSError, KeyError, ValueError):
+            pass
+
+    columns = {}
+    records = 0
+    with open(path) as stats:
+        for line in stats:
+            parsed_line = line.split()
+            if len(parsed_line) == 1:
+                # Строка с ключом начинает новую запись, разделитель "---------" пропускается
+                if not parsed_line[0].startswith("-"):
+                    records += 1
+                continue
+            if len(parsed_line) < 2 or not records:
+                continue
+            # Для timestamp_after сохраняется только время, оно используется для оси абсцисс
+            if "timestamp_after" in line:
+                name, value = "timestamp_after", parsed_line[-1]
             else:
-                statistics[parsed_line[0]].append(parsed_line[1])
+                name, value = parsed_line[0], parsed_line[1]
+            values = columns.setdefault(name, [])
+            if len(values) == records:
+                # Повтор параметра в одной записи - остаётся последнее значение
+                values[-1] = value
+                continue
+            values.extend([None] * (records - 1 - len(values)))
+            values.append(value)
 
+    statistics = {}
+    for name, values in columns.items():
+        values.extend([None] * (records - len(values)))
+        try:
+            statistics[name] = np.array(["nan" if value is None else value for value in values]).astype(np.float64)
+        except ValueError:
+            statistics[name] = np.array(["" if value is None else value for value in values], dtype=str)
 
-# Создание графика на основе данных из словаря statistics
-def make_plot(monitoring_parameter):
-    print(len(statistics["rb_general_cpu_usage"]))
-    fig = plt.figure(figsize=(35, 10))
+    if use_cache:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(temp_file, "wb") as cache:
+                np.savez(cache, __file_id__=file_id, **statistics)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"Не удалось сохранить кэш {cache_file}: {e}")
+    return statistics
+
+
+# Прореживание ряда для графика: ряд делится на buckets частей и в каждой остаются точки с минимальным
+# и максимальным значением, поэтому пики сохраняются. Возвращает отсортированные индексы оставшихся точек.
+# Считается векторно: ряд дополняется nan до кратной длины и разворачивается в матрицу buckets x k
+def downsample_minmax(values, buckets):
+    count = len(values)
+    if count <= 2 * buckets:
+        return np.arange(count)
+    bucket_size = -(-count // buckets)
+    padded = np.full(buckets * bucket_size, np.nan)
+    padded[:count] = values
+    matrix = padded.reshape(buckets, bucket_size)
+    nan = np.isnan(matrix)
+    offsets = np.arange(buckets) * bucket_size
+    minimums = offsets + np.argmin(np.where(nan, np.inf, matrix), axis=1)
+    maximums = offsets + np.argmax(np.where(nan, -np.inf, matrix), axis=1)
+    indexes = np.unique(np.concatenate((minimums, maximums)))
+    return indexes[indexes < count]
+
+
+# matplotlib загружается почти секунду, поэтому импортируется только при построении графика, а не при разборе
+# статистики (parse_stats используется и в accuracy_report.py). backend задаётся до импорта pyplot
+def pyplot(backend=None):
+    import matplotlib
+
+    if backend is not None:
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+# Параметры для графика группы: числовые колонки, в имени которых есть подстрока группы.
+# Максимум и перцентили за период (поля _max, _p50, _p95, _p99) строятся на отдельном графике группы
+# (peaks=True или группа вида cpu_max), а собственное потребление сборщика (psutil_self_*) - только если
+# оно указано в группе явно, иначе на графике оказываются десятки рядов
+def plot_parameters(statistics, monitoring_parameter, peaks=False):
+    peaks = peaks or monitoring_parameter.rsplit("_", 1)[-1] in PEAK_KINDS
+    return [
+        key
+        for key, values in statistics.items()
+        if monitoring_parameter in key
+        and values.dtype == np.float64
+        and (key.rsplit("_", 1)[-1] in PEAK_KINDS) == peaks
+        and (not key.startswith("psutil_self_") or "self" in monitoring_parameter)
+    ]
+
+
+# Создание графика на основе данных из словаря statistics. По оси абсцисс - номера записей,
+# подписанные временем из timestamp_after. Возвращает фигуру и средние значения параметров за интервал
+def draw_plot(statistics, monitoring_parameter, start, end, peaks=False):
+    plt = pyplot()
+    fig = plt.figure(figsize=FIGSIZE, dpi=DPI)
     plt.grid()
     plt.yticks(fontsize=6)
-    plt.xticks(rotation=90)
     # Отдельные настройки для оси ординат
     if "cpu" in monitoring_parameter:
         y = np.arange(1, 101)
         plt.ylim(0, 100)
         plt.yticks(y, y)
-    timestamp_line = np.array(statistics["timestamp_after"][int(sys.argv[1]) : int(sys.argv[2])])
-    parameter_names = []
-    for key in statistics.keys():
-        if monitoring_parameter in key:
-            parameter_names.append(key)
+    timestamp_line = statistics["timestamp_after"][start:end]
+    positions = np.arange(len(statistics["timestamp_after"]))[start:end]
+    ticks = np.linspace(0, len(positions) - 1, min(X_TICKS, len(positions))).astype(int)
+    plt.xticks(positions[ticks], timestamp_line[ticks], rotation=90)
+    parameter_names = plot_parameters(statistics, monitoring_parameter, peaks)
+    averages = {}
+    buckets = FIGSIZE[0] * DPI // 2
     for name in parameter_names:
-        locals()[name] = np.array([float(i) for i in statistics[name]][int(sys.argv[1]) : int(sys.argv[2])])
-        plt.plot(timestamp_line, locals()[name], label=name)
-        print(f"Average {name} " + str(mean(locals()[name])))
+        values = statistics[name][start:end]
+        shown = downsample_minmax(values, buckets)
+        plt.plot(positions[shown], values[shown], label=name)
+        averages[name] = np.nanmean(values)
     plt.legend()
-    plt.show()
+    return fig, averages
+
+
+def make_plot(statistics, monitoring_parameter, start, end, peaks=False):
+    print(len(statistics["rb_general_cpu_usage"]))
+    fig, averages = draw_plot(statistics, monitoring_parameter, start, end, peaks)
+    for name, average in averages.items():
+        print(f"Average {name} " + str(average))
+    pyplot().show()
+
+
+# Построение графика одной группы параметров в файл. Выполняется в отдельном процессе:
+# статистика загружается из кэша, который к этому моменту уже создан основным процессом
+def render_plot(path, monitoring_parameter, start, end, output_dir, image_format, use_cache=True, peaks=False):
+    plt = pyplot("Agg")
+    statistics = parse_stats(path, use_cache)
+    if not plot_parameters(statistics, monitoring_parameter, peaks):
+        return None
+    fig, _ = draw_plot(statistics, monitoring_parameter, start, end, peaks)
+    name = monitoring_parameter.replace("%", "percent") + ("_peaks" if peaks else "")
+    file_name = os.path.join(output_dir, f"{name}.{image_format}")
+    fig.savefig(file_name, bbox_inches="tight")
+    plt.close(fig)
+    return file_name
+
+
+# Пакетное построение графиков для групп параметров в пуле процессов, без вывода на экран.
+# При peaks=True для каждой группы строится и график максимума и перцентилей за период (<группа>_peaks)
+def render_plots(path, groups, start, end, output_dir, image_format="png", jobs=None, use_cache=True, peaks=False):
+    os.makedirs(output_dir, exist_ok=True)
+    # Разбор файла и создание кэша до запуска процессов, чтобы файл не разбирался в каждом из них
+    parse_stats(path, use_cache)
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [
+            pool.submit(render_plot, path, group, start, end, output_dir, image_format, use_cache, group_peaks)
+            for group in groups
+            for group_peaks in ((False, True) if peaks else (False,))
+        ]
+        return [future.result() for future in futures]
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Построение графика по файлу statistics")
+    parser.add_argument("start", type=int, help="номер первой записи")
+    parser.add_argument("end", type=int, help="номер записи, до которой строится график")
+    parser.add_argument(
+        "parameter",
+        nargs="?",
+        help="подстрока в именах параметров, например cpu или io_usage_r; в пакетном режиме по умолчанию - "
+        "все группы параметров",
+    )
+    parser.add_argument("--statistics", default="statistics", help="файл со статистикой (по умолчанию statistics)")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш разобранного файла")
+    parser.add_argument("--batch", metavar="DIR", help="сохранить графики в директорию DIR без вывода на экран")
+    parser.add_argument("--format", choices=("png", "svg"), default="png", help="формат файлов графиков")
+    parser.add_argument("--jobs", type=int, help="количество процессов для построения графиков")
+    parser.add_argument(
+        "--peaks",
+        action="store_true",
+        help="максимум и перцентили за период: в пакетном режиме - отдельные графики <группа>_peaks, "
+        "иначе - вместо основных параметров",
+    )
+    args = parser.parse_args()
 
-parse_stats()
-make_plot(sys.argv[3])
+    if args.batch:
+        groups = [args.parameter] if args.parameter else PARAMETER_GROUPS
+        for file_name in render_plots(
+            args.statistics,
+            groups,
+            args.start,
+            args.end,
+            args.batch,
+            args.format,
+            args.jobs,
+            not args.no_cache,
+            args.peaks,
+        ):
+            if file_name:
+                print(file_name)
+    elif args.parameter is None:
+        parser.error("укажите параметр или используйте --batch")
+    else:
+        statistics = parse_stats(args.statistics, use_cache=not args.no_cache)
+        make_plot(statistics, args.parameter, args.start, args.end, args.peaks)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+# Значение в формате OpenMetrics: nan и бесконечности записываются как NaN, +Inf и -Inf
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+# Экранирование значения метки: обратная косая черта, перевод строки и кавычка
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+# Текст в формате OpenMetrics. families - список (имя, тип gauge или counter, описание, [(метки, значение), ...]).
+# У счётчиков к имени значения добавляется суффикс _total, как требует формат
+def render_openmetrics(families):
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"# HELP {name} {help_text}")
+        sample_name = f"{name}_total" if kind == "counter" else name
+        for labels, value in samples:
+            lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+    lines.append("# EOF")
+    return ("\n".join(lines) + "\n").encode()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # Соединения scrape-запросов переиспользуются (keep-alive)
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    body = render_openmetrics([])
+
+
+# HTTP-сервер с показателями в формате OpenMetrics по адресу /metrics. Работает в отдельном потоке,
+# каждый запрос обслуживается в своём потоке. Ответ готовится заранее: publish подменяет готовое тело ответа
+# одним присваиванием, поэтому запросы не обращаются к хранилищам статистики и не ждут сбора,
+# а сбор не ждёт запросов
+class MetricsExporter:
+    def __init__(self, host="127.0.0.1", port=9464):
+        self._server = _MetricsServer((host, port), _MetricsHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def publish(self, body):
+        self._server.body = body
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
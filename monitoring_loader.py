@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+
+# Формат имён файлов мониторинга RuBackup
+TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M-%S"
+# Формат полей timestamp_before и timestamp_after в файлах мониторинга без миллисекунд,
+# например "Sun Oct 18 2026 15:33:12:100"
+RB_TIMESTAMP_FORMAT = "%a %b %d %Y %H:%M:%S"
+# Кэш разобранных файлов мониторинга по умолчанию
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "test_monitoring")
+DEFAULT_CACHE = os.path.join(CACHE_DIR, "monitoring_files.sqlite")
+# Параметры файла мониторинга, которые всегда остаются строками (hwid может состоять из одних цифр)
+STRING_FIELDS = ("hwid", "hostname", "timestamp_before", "timestamp_after")
+
+
+# Перевод имени файла мониторинга в миллисекунды epoch. Для посторонних файлов возвращается None
+def monitoring_file_timestamp(file_name):
+    try:
+        return int(datetime.strptime(file_name, TIMESTAMP_FORMAT).timestamp()) * 1000
+    except ValueError:
+        return None
+
+
+# Перевод значения timestamp_before или timestamp_after в миллисекунды epoch. Если значения нет
+# или оно в другом формате, возвращается None
+def rb_timestamp(value):
+    if not isinstance(value, str):
+        return None
+    moment, _, milliseconds = value.rpartition(":")
+    try:
+        return int(datetime.strptime(moment, RB_TIMESTAMP_FORMAT).timestamp()) * 1000 + int(milliseconds)
+    except ValueError:
+        return None
+
+
+# То же для колонки таблицы файлов мониторинга: массив float64 с nan для отсутствующих значений
+def rb_timestamps(values):
+    timestamps = np.full(len(values), np.nan)
+    for i, value in enumerate(values.tolist()):
+        timestamp = rb_timestamp(value)
+        if timestamp is not None:
+            timestamps[i] = timestamp
+    return timestamps
+
+
+# Разбор данных из файла мониторинга. Для всех параметров добавляется префикс rb_, к general и client_ram_usage
+# ещё и постфикс _%, чтобы не было совпадающих шаблонов в именах параметров.
+# Числовые значения (в файле они записаны строками, например "23.000000") переводятся в float,
+# остальные (hwid, hostname, timestamp_before/after) остаются строками
+def parse_monitoring_data(monitoring_file_data):
+    data = {}
+    for stat_name, value in monitoring_file_data.items():
+        if stat_name == "general_ram_usage" or stat_name == "client_ram_usage":
+            stat_name = f"{stat_name}_%"
+        if stat_name in STRING_FIELDS:
+            data[f"rb_{stat_name}"] = value
+            continue
+        try:
+            data[f"rb_{stat_name}"] = float(value)
+        except (TypeError, ValueError):
+            data[f"rb_{stat_name}"] = value
+    return data
+
+
+# Имя показателя RuBackup, который соответствует показателю psutil:
+# psutil_general_cpu - rb_general_cpu_usage, psutil_client_io_usage_r - rb_client_io_usage_r и т.д.
+def rb_counterpart(name):
+    rb_name = "rb_" + name[len("psutil_") :]
+    if rb_name.endswith("_cpu"):
+        rb_name += "_usage"
+    return rb_name
+
+
+def parse_monitoring_file(path):
+    with open(path, "r") as j:
+        return parse_monitoring_data(json.load(j))
+
+
+# Загрузка файлов мониторинга из директории в таблицу: словарь колонок numpy, отсортированных по времени.
+# Колонка timestamp - время из имени файла в миллисекундах epoch, числовые параметры - float64 (nan,
+# если параметра в файле нет), строковые - массивы строк.
+# Разобранные файлы сохраняются в кэш sqlite с ключом (имя файла, время изменения, размер),
+# поэтому при повторной загрузке разбираются только новые или изменившиеся файлы.
+# Новые файлы читаются параллельно в пуле потоков
+def load_monitoring_files(directory, cache=DEFAULT_CACHE, jobs=8):
+    files = []
+    for entry in os.scandir(directory):
+        timestamp = monitoring_file_timestamp(entry.name)
+        if timestamp is not None and entry.is_file():
+            file_stat = entry.stat()
+            files.append((entry.name, timestamp, file_stat.st_mtime_ns, file_stat.st_size))
+
+    cached = {}
+    connection = None
+    if cache:
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        connection = sqlite3.connect(cache)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, data TEXT)"
+        )
+        directory_path = os.path.abspath(directory)
+        for path, mtime_ns, size, data in connection.execute(
+            "SELECT path, mtime_ns, size, data FROM files WHERE path LIKE ?", (os.path.join(directory_path, "%"),)
+        ):
+            cached[path] = (mtime_ns, size, data)
+
+    rows = {}
+    new_files = []
+    for name, timestamp, mtime_ns, size in files:
+        path = os.path.join(os.path.abspath(directory), name)
+        entry = cached.get(path)
+        if entry is not None and entry[:2] == (mtime_ns, size):
+            rows[timestamp] = json.loads(entry[2])
+        else:
+            new_files.append((path, timestamp, mtime_ns, size))
+
+    def parse(new_file):
+        try:
+            return parse_monitoring_file(new_file[0])
+        except (OSError, ValueError):
+            # Файл удалён или ещё не дописан - будет разобран при следующей загрузке
+            return None
+
+    with ThreadPoolExecutor(jobs) as pool:
+        parsed = list(pool.map(parse, new_files))
+    if connection is not None:
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [
+                    (path, mtime_ns, size, json.dumps(data))
+                    for (path, _, mtime_ns, size), data in zip(new_files, parsed)
+                    if data is not None
+                ],
+            )
+        connection.close()
+    for (_, timestamp, _, _), data in zip(new_files, parsed):
+        if data is not None:
+            rows[timestamp] = data
+    return make_table(rows)
+
+
+# Сборка таблицы из словаря {время: параметры файла}
+def make_table(rows):
+    timestamps = sorted(rows)
+    table = {"timestamp": np.array(timestamps, dtype=np.int64)}
+    names = dict.fromkeys(name for data in rows.values() for name in data)
+    for name in names:
+        values = [rows[timestamp].get(name) for timestamp in timestamps]
+        if all(value is None or isinstance(value, float) for value in values):
+            table[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        else:
+            table[name] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+    return table
+
+
+# Поиск строк таблицы с указанными метками времени двоичным поиском: например, файлов мониторинга
+# для записей за период или записей за период для файлов. Возвращает индексы строк и маску найденных меток
+def join_table(table, timestamps):
+    file_timestamps = table["timestamp"]
+    indexes = np.searchsorted(file_timestamps, timestamps)
+    indexes = np.minimum(indexes, max(len(file_timestamps) - 1, 0))
+    found = file_timestamps[indexes] == timestamps if len(file_timestamps) else np.zeros(len(timestamps), bool)
+    return indexes, found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Загрузка файлов мониторинга RuBackup в таблицу")
+    parser.add_argument("directory", help="директория с файлами мониторинга")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help=f"файл кэша (по умолчанию {DEFAULT_CACHE})")
+    parser.add_argument("--jobs", type=int, default=8, help="количество потоков для чтения файлов")
+    parser.add_argument("--output", help="сохранить таблицу в файл .npz")
+    args = parser.parse_args()
+
+    table = load_monitoring_files(args.directory, args.cache, args.jobs)
+    print(f"Файлов: {len(table['timestamp'])}, параметров: {len(table) - 1}")
+    if args.output:
+        np.savez(args.output, **table)
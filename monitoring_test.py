@@ -1,46 +1,617 @@
 #!/usr/bin/env python3
 
+import os
 from subprocess import getoutput
 import psutil
+import argparse
 from collections import defaultdict
 from platform import node
-import sys
-from os import listdir
 from datetime import datetime
-from time import sleep
-from json import load as load
+from json import JSONDecodeError
+import math
 import re
+import time
+import numpy as np
+from stats_store import StatsStore
+from period_aggregator import (
+    PeriodAggregator,
+    PEAK_KINDS,
+    PERIOD_FIELDS,
+    peak_fields,
+    target_period_fields,
+    weighted_peaks,
+)
+from monitoring_watcher import MonitoringWatcher
+from scheduler import AdaptiveStride, TickScheduler
+from proc_reader import ProcReader
+from process_tree import PsutilSampler
+from targets import Target, parse_target
+from concurrent.futures import ThreadPoolExecutor
+from async_collector import AsyncCollector, snapshot_skew, timed_call
+from stage_timer import StageTimer
+import asyncio
+import heapq
+import signal
+from stats_output import StatisticsWriter, JsonlWriter
+from rollups import ROLLUP_LEVELS, Rollup
+from raw_counters import RawCountersWriter, read_raw_counters
+from metrics_exporter import MetricsExporter, render_openmetrics
+from fleet import FleetSender, parse_address
+from monitoring_loader import (
+    CACHE_DIR,
+    DEFAULT_CACHE,
+    TIMESTAMP_FORMAT,
+    join_table,
+    load_monitoring_files,
+    monitoring_file_timestamp,
+    parse_monitoring_file,
+    rb_counterpart,
+    rb_timestamp,
+    rb_timestamps,
+)
+
+parser = argparse.ArgumentParser(description="Сбор статистики для проверки мониторинга RuBackup")
+parser.add_argument("monitoring_period", type=int, help="период мониторинга RuBackup в секундах")
+parser.add_argument(
+    "records", type=int, nargs="?", help="необходимое количество записей (при --replay и --daemon не указывается)"
+)
+parser.add_argument(
+    "--watch",
+    choices=("auto", "inotify", "poll", "off"),
+    default="auto",
+    help="отслеживание файлов мониторинга во время сбора: auto - inotify, а при его недоступности "
+    "периодическое чтение директории; off - обработка всех файлов после окончания сбора",
+)
+parser.add_argument(
+    "--interval",
+    type=float,
+    default=1.0,
+    help="интервал сбора статистики в секундах, можно меньше секунды (по умолчанию 1)",
+)
+parser.add_argument(
+    "--backend",
+    choices=("psutil", "proc"),
+    default="psutil",
+    help="способ сбора статистики процессов rubackup_client: psutil или прямое чтение /proc "
+    "с постоянно открытыми файлами (меньше нагрузка от самого сборщика)",
+)
+parser.add_argument(
+    "--target",
+    action="append",
+    default=[],
+    metavar="МЕТКА=ТИП:ЗНАЧЕНИЕ",
+    help="дополнительный процесс для сбора статистики вместе с дочерними процессами, тип - name (подстрока "
+    "в имени процесса), pidfile или cgroup, например server=name:rubackup_server. Можно указать несколько раз. "
+    "Цель с меткой client сравнивается с показателями client из файлов мониторинга "
+    "(по умолчанию client=name:rubackup_client)",
+)
+parser.add_argument(
+    "--statistics", default="statistics", help="текстовый файл со статистикой за периоды (по умолчанию statistics)"
+)
+parser.add_argument(
+    "--output",
+    help="файл JSON Lines, в который дописываются статистика за каждый такт и статистика за периоды",
+)
+parser.add_argument(
+    "--batch-size", type=int, default=64, help="количество записей, после которого они сбрасываются в файлы"
+)
+parser.add_argument(
+    "--flush-interval",
+    type=float,
+    default=1.0,
+    help="максимальное время в секундах, которое записи ждут сброса в файлы (по умолчанию 1)",
+)
+parser.add_argument("--fsync", action="store_true", help="вызывать fsync после каждого сброса записей в файлы")
+parser.add_argument(
+    "--monitoring-cache",
+    default=DEFAULT_CACHE,
+    help="кэш разобранных файлов мониторинга для --watch off, пустая строка - без кэша "
+    f"(по умолчанию {DEFAULT_CACHE})",
+)
+parser.add_argument(
+    "--engine",
+    choices=("sync", "async"),
+    default="sync",
+    help="способ сбора за такт: sync - последовательно; async - снимки системы и процессов и обработка файлов "
+    "мониторинга выполняются одновременно",
+)
+parser.add_argument(
+    "--proc-path",
+    default="/proc",
+    help="путь к файловой системе proc, например /host/proc при запуске в контейнере (по умолчанию /proc)",
+)
+parser.add_argument(
+    "--monitoring-dir",
+    help="директория с файлами мониторинга RuBackup; если не указана, путь составляется из имени хоста "
+    "и hwid, полученного от rubackup_client",
+)
+parser.add_argument(
+    "--no-hwid-cache",
+    action="store_true",
+    help="не использовать сохранённый путь к директории мониторинга, а заново получить hwid от rubackup_client",
+)
+parser.add_argument(
+    "--subtract-self",
+    action="store_true",
+    help="вычитать потребление cpu, io и памяти самим сборщиком из общесистемной статистики psutil_general_*",
+)
+parser.add_argument(
+    "--disk-pattern",
+    default=r"^[a-z]d[a-z]+$",
+    help="регулярное выражение для имён дисков, по которым считается общесистемный io (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--record",
+    metavar="FILE",
+    help="записывать накопленные счётчики каждого такта в двоичный файл для последующего --replay",
+)
+parser.add_argument(
+    "--replay",
+    metavar="FILE",
+    help="не собирать статистику, а пересчитать её по файлу, записанному с --record, с текущими "
+    "периодом, --disk-pattern и --subtract-self. Цели и интервал берутся из файла",
+)
+parser.add_argument(
+    "--replay-periods",
+    type=lambda text: [int(period) for period in text.split(",")],
+    default=[],
+    metavar="ПЕРИОД[,ПЕРИОД...]",
+    help="при --replay дополнительно посчитать статистику за эти периоды в секундах; записи на границах "
+    "каждого периода пишутся в файл <statistics>.<период>s",
+)
+parser.add_argument(
+    "--daemon",
+    action="store_true",
+    help="собирать статистику до остановки (SIGTERM или Ctrl-C), а не заданное количество записей. "
+    "Ежесекундная статистика хранится в памяти --retention секунд, файлы ротируются по --rotate-size, "
+    "а статистика сворачивается в минутные и часовые интервалы (--rollups)",
+)
+parser.add_argument(
+    "--retention",
+    type=int,
+    default=600,
+    help="сколько секунд в памяти хранятся статистика за такты и записи за период в ожидании файла мониторинга "
+    "(по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--rollups",
+    metavar="ПРЕФИКС",
+    help="файлы JSON Lines <префикс>.1m.jsonl и <префикс>.1h.jsonl с минимумом, максимумом, средним и суммой "
+    "каждого показателя за минуту и за час (при --daemon по умолчанию rollups)",
+)
+parser.add_argument(
+    "--rotate-size",
+    type=float,
+    help="размер файла результатов в мегабайтах, после которого он ротируется, 0 - без ротации "
+    "(по умолчанию 64 при --daemon, иначе 0)",
+)
+parser.add_argument(
+    "--rotate-keep",
+    type=int,
+    default=3,
+    help="количество хранимых старых файлов результатов после ротации (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--top",
+    type=int,
+    default=0,
+    metavar="N",
+    help="для каждой цели записывать в файл --output N процессов с наибольшим потреблением cpu "
+    "и N процессов с наибольшим io за каждый период мониторинга (записи top)",
+)
+parser.add_argument(
+    "--adaptive",
+    type=float,
+    metavar="MAX_INTERVAL",
+    help="адаптивная частота сбора: при активности статистика собирается с интервалом --interval, а без неё "
+    "интервал постепенно увеличивается до MAX_INTERVAL секунд. Статистика за период взвешивается по времени",
+)
+parser.add_argument(
+    "--busy-cpu",
+    type=float,
+    default=5.0,
+    help="порог cpu цели client в процентах, выше которого узел считается активным (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--busy-io",
+    type=float,
+    default=1024.0,
+    help="порог чтения и записи цели client в КБ/с для --adaptive (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--busy-net",
+    type=float,
+    default=1024.0,
+    help="порог входящего и исходящего трафика узла в КБ/с для --adaptive (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--idle-ticks",
+    type=int,
+    default=5,
+    help="через сколько тактов без активности интервал сбора увеличивается (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help="порт HTTP-сервера с текущей статистикой в формате OpenMetrics (Prometheus) по адресу /metrics",
+)
+parser.add_argument(
+    "--metrics-host",
+    default="127.0.0.1",
+    help="адрес, на котором принимает запросы сервер --metrics-port (по умолчанию %(default)s)",
+)
+parser.add_argument(
+    "--fleet",
+    metavar="АДРЕС",
+    help="адрес агрегатора (aggregator.py), которому передаётся статистика: хост:порт или unix:/путь",
+)
+parser.add_argument("--fleet-host", default=node(), help="имя узла для агрегатора (по умолчанию имя хоста)")
+parser.add_argument(
+    "--fleet-buffer",
+    type=int,
+    default=3600,
+    help="сколько секунд статистики хранить для передачи, пока агрегатор недоступен (по умолчанию %(default)s)",
+)
+args = parser.parse_args()
+if args.metrics_port is not None and args.replay:
+    parser.error("--metrics-port недоступен при --replay")
+if args.fleet and args.replay:
+    parser.error("--fleet недоступен при --replay")
+if args.fleet:
+    try:
+        fleet_address = parse_address(args.fleet)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.fleet_buffer <= 0:
+        parser.error("--fleet-buffer должен быть больше 0")
+if args.adaptive is not None and args.replay:
+    parser.error("--adaptive нельзя указывать вместе с --replay: при пересчёте используются записанные такты")
+if args.top < 0 or (args.top and (not args.output or args.replay)):
+    parser.error("--top требует --output и недоступен при --replay")
+if args.daemon:
+    if args.replay or args.record:
+        parser.error("--daemon нельзя указывать вместе с --replay или --record")
+    if args.watch == "off":
+        parser.error("при --daemon файлы мониторинга должны обрабатываться во время сбора, --watch off недоступен")
+    if args.rollups is None:
+        args.rollups = "rollups"
+    if args.rotate_size is None:
+        args.rotate_size = 64
+if args.retention <= 0 or args.rotate_keep < 0 or (args.rotate_size or 0) < 0:
+    parser.error("--retention должен быть больше 0, а --rotate-size и --rotate-keep - не меньше 0")
+if args.replay:
+    if args.record:
+        parser.error("--record и --replay нельзя указывать вместе")
+    replay_metadata, replay_records = read_raw_counters(args.replay)
+    # Цели и интервал сбора - из записанного файла. Файлы мониторинга обрабатываются после пересчёта
+    target_specs = [(label, "replay", None) for label in replay_metadata["labels"]]
+    args.interval = replay_metadata["interval_ms"] / 1000
+    args.watch = "off"
+else:
+    if args.records is None and not args.daemon:
+        parser.error("укажите необходимое количество записей")
+    if args.records is not None and args.records < 1:
+        parser.error("количество записей должно быть больше 0")
+    if args.replay_periods:
+        parser.error("--replay-periods используется только вместе с --replay")
+    try:
+        target_specs = [parse_target(spec) for spec in args.target]
+    except ValueError as e:
+        parser.error(str(e))
+    labels = [spec[0] for spec in target_specs]
+    if len(set(labels)) != len(labels) or "general" in labels or "self" in labels:
+        parser.error("метки целей должны быть уникальными и не могут быть general или self")
+    # Цель client идёт первой, её статистика попадает в поля psutil_client_*
+    if "client" not in labels:
+        target_specs.insert(0, ("client", "name", "rubackup_client"))
+    target_specs.sort(key=lambda spec: spec[0] != "client")
+try:
+    disk_name_pattern = re.compile(args.disk_pattern)
+except re.error as e:
+    parser.error(f"неверное --disk-pattern: {e}")
 
 # Период мониторинга. Передаётся аргументом к скрипту
-monitoring_period = int(sys.argv[1])
+monitoring_period = args.monitoring_period
 # Необходимое количество записей
-records = int(sys.argv[2])
-# Количество итераций для необходимого количества записей
-iterations = monitoring_period * records
+records = args.records
+# Интервал сбора в миллисекундах. Чтобы такты совпадали с секундами из имён файлов мониторинга,
+# интервал должен делить секунду нацело или быть кратным секунде, а период - быть кратным интервалу
+interval_ms = round(args.interval * 1000)
+if interval_ms <= 0 or (1000 % interval_ms and interval_ms % 1000) or (monitoring_period * 1000) % interval_ms:
+    parser.error("интервал должен делить секунду нацело или быть кратным ей, а период - быть кратным интервалу")
+# Счётчики cpu в /proc/stat меняются шагами 1/USER_HZ секунды, за более короткий интервал они могут не измениться
+if interval_ms * os.sysconf("SC_CLK_TCK") < 1000:
+    parser.error(f"интервал не может быть меньше шага счётчиков cpu (1/{os.sysconf('SC_CLK_TCK')} с)")
+if any(period <= 0 or (period * 1000) % interval_ms for period in args.replay_periods):
+    parser.error("периоды --replay-periods должны быть кратны интервалу записанного сбора")
+# Количество секунд и итераций для необходимого количества записей. При пересчёте - все записанные такты,
+# при --daemon количество не ограничено
+if args.replay:
+    iterations = len(replay_records)
+    if iterations:
+        seconds = int(replay_records["timestamp"][-1] - replay_records["timestamp"][0] + interval_ms) // 1000
+    else:
+        seconds = 0
+elif args.daemon:
+    iterations = seconds = None
+else:
+    seconds = monitoring_period * records
+    iterations = seconds * 1000 // interval_ms
+# Количество итераций, которое приходится на один период мониторинга
+period_iterations = monitoring_period * 1000 // interval_ms
+
+# Адаптивная частота сбора (--adaptive): такт выполняется через stride интервалов. Допустимы только шаги,
+# для которых такты остаются на границах секунд и попадают на границы периода мониторинга
+adaptive = None
+if args.adaptive is not None:
+    strides = [
+        stride
+        for stride in range(1, round(args.adaptive * 1000) // interval_ms + 1)
+        if (1000 % (stride * interval_ms) == 0 or stride * interval_ms % 1000 == 0)
+        and (monitoring_period * 1000) % (stride * interval_ms) == 0
+    ]
+    if len(strides) < 2 or args.idle_ticks < 1:
+        parser.error("максимальный интервал --adaptive должен допускать хотя бы один интервал больше --interval")
+    adaptive = AdaptiveStride(strides, args.idle_ticks)
 
-print(f"{iterations} секунд необходимо для сбора статистики")
+# Сколько тактов хранятся записи за период в ожидании файла мониторинга с тем же именем (--retention секунд).
+# Без отслеживания файлов во время сбора (--watch off) записи хранятся до конца сбора
+# (хранилища не меньше чем на один такт, даже если при пересчёте записанных тактов нет)
+if args.watch == "off":
+    retention_iterations = max(1, iterations)
+else:
+    retention_iterations = max(period_iterations, args.retention * 1000 // interval_ms)
+    if iterations is not None:
+        retention_iterations = min(iterations, retention_iterations)
+
+# Из имени хоста и полученого hwid составляется путь до директории с файлами мониторинга.
+# Запуск rubackup_client hwid занимает заметное время, поэтому путь сохраняется в кэш для каждого хоста.
+# В кэш попадает только путь к существующей директории. Путь из кэша используется, пока директория существует
+# и среди директорий этого хоста (<хост>_<hwid>) изменялась последней: после повторной регистрации клиента
+# с новым hwid файлы пишутся в новую директорию, а старая остаётся, и путь определяется заново
+MONITORING_ROOT = "/opt/rubackup/monitoring/"
+
+
+def latest_host_directory(hostname):
+    try:
+        directories = [
+            entry
+            for entry in os.scandir(MONITORING_ROOT)
+            if entry.name.startswith(f"{hostname}_") and entry.is_dir()
+        ]
+    except OSError:
+        return None
+    if not directories:
+        return None
+    return MONITORING_ROOT + max(directories, key=lambda entry: entry.stat().st_mtime_ns).name + "/"
 
-# Из имени хоста и полученого hwid составляется путь до директории с файлами мониторинга
-hostname = node()
-hwid = getoutput("/opt/rubackup/bin/rubackup_client hwid").split("\n")[2]
-monitoring_files_path = "/opt/rubackup/monitoring/" + hostname + "_" + hwid + "/"
 
-# Создание словарей для последующего размещения в них собранной статистики.
-# Словари с постфиксом "_counters" используются для собираемой ежесекундно статистики, из которой будет считаться
+def resolve_monitoring_files_path(use_cache=True):
+    hostname = node()
+    cache_file = os.path.join(CACHE_DIR, f"monitoring_path_{hostname}")
+    if use_cache:
+        try:
+            with open(cache_file) as cached:
+                path = cached.read().strip()
+            if os.path.isdir(path) and latest_host_directory(hostname) == path:
+                print(f"Директория мониторинга из кэша: {path} (--no-hwid-cache, чтобы определить заново)")
+                return path
+        except OSError:
+            pass
+    hwid = getoutput("/opt/rubackup/bin/rubackup_client hwid").split("\n")[2]
+    path = MONITORING_ROOT + hostname + "_" + hwid + "/"
+    if os.path.isdir(path):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cache_file, "w") as cached:
+                cached.write(path)
+        except OSError as e:
+            print(f"Не удалось сохранить путь к директории мониторинга в {cache_file}: {e}")
+    return path
+
+
+if args.monitoring_dir:
+    monitoring_files_path = os.path.join(args.monitoring_dir, "")
+elif args.replay:
+    monitoring_files_path = replay_metadata["monitoring_files_path"]
+else:
+    monitoring_files_path = resolve_monitoring_files_path(not args.no_hwid_cache)
+
+# Общесистемная статистика psutil тоже читается из указанной файловой системы proc
+psutil.PROCFS_PATH = args.proc_path
+
+# Показатели, которые хранятся в каждом из хранилищ статистики
+GENERAL_COUNTERS_COLUMNS = (
+    "total_cpu_time",
+    "total_use_cpu_time",
+    "net_in",
+    "net_out",
+    "io_read",
+    "io_write",
+    "memory_usage_percent",
+    "memory_usage_m",
+)
+CLIENT_COUNTERS_COLUMNS = ("client_cpu_time", "client_io_read", "client_io_write", "client_memory")
+GENERAL_STATS_COLUMNS = (
+    "cpu_percent",
+    "net_in",
+    "net_out",
+    "io_read",
+    "io_write",
+    "memory_usage_percent",
+    "memory_usage_m",
+)
+CLIENT_STATS_COLUMNS = (
+    "client_cpu_percent",
+    "client_io_read",
+    "client_io_write",
+    "client_memory_percent",
+    "client_memory_m",
+)
+
+# Создание хранилищ для последующего размещения в них собранной статистики.
+# Хранилища с постфиксом "_counters" используются для собираемой ежесекундно статистики, из которой будет считаться
 # дельта между показателями за текущую секунду и предыдущую.
 # Дельта будет использована при расчёте процентов для некоторых показателей и для перевода в другие еденицы измерения.
-# После расчёта процентов и перевода дельты в необходимые единицы измерения, полученные значения помещаются в словари
+# После расчёта процентов и перевода дельты в необходимые единицы измерения, полученные значения помещаются в хранилища
 # general_stats и client_stats.
-general_stats_counters = {}
-client_stats_counters = {}
-general_stats = {}
-client_stats = {}
+# Хранилища имеют фиксированный размер и заранее выделяют память, метки времени - миллисекунды epoch.
+# Для статистики за такт нужны только текущая и предыдущая записи, а накопленные счётчики хранятся столько же,
+# сколько записи за период, - по ним считается статистика за окно из файла мониторинга.
+# Всё собранное сразу записывается в файлы, поэтому потребление памяти не растёт с длительностью сбора
+COUNTERS_CAPACITY = max(2, retention_iterations)
+general_stats_counters = StatsStore(GENERAL_COUNTERS_COLUMNS, COUNTERS_CAPACITY)
+client_stats_counters = StatsStore(CLIENT_COUNTERS_COLUMNS, COUNTERS_CAPACITY)
+general_stats = StatsStore(GENERAL_STATS_COLUMNS, 1)
+client_stats = StatsStore(CLIENT_STATS_COLUMNS, 1)
+# Опоздание каждого такта относительно дедлайна (в секундах), количество пропущенных перед ним тактов
+# и расхождение во времени между снимками системы и процессов (в секундах)
+tick_stats = StatsStore(("lateness", "missed", "skew"), retention_iterations)
+
+# Для --backend proc статистика процессов читается напрямую из /proc.
+# У каждой цели свой экземпляр, так как цели опрашиваются параллельно
+def make_sampler():
+    return ProcReader(args.proc_path) if args.backend == "proc" else PsutilSampler()
+
 
-# Поиск pid'а для процесса rubackup_client. Создаё список, потому что потом добавим в него все дочерние процессы
-pid_and_childs_pids = [proc.pid for proc in psutil.process_iter() if "rubackup_client" in proc.name()]
+# Отслеживаемые цели. Для каждой цели есть свои хранилища накопленных счётчиков и статистики за такт,
+# для цели client это client_stats_counters и client_stats. При пересчёте процессы не опрашиваются
+# и объекта Target у цели нет
+client_targets = []
+for label, kind, value in target_specs:
+    target = None
+    if not args.replay:
+        target = Target(label, kind, value, make_sampler(), proc_path=args.proc_path)
+        if not target.tree.roots:
+            print(f"Процессы цели {label} ({kind}:{value}) не найдены, поиск будет повторяться")
+        if args.top:
+            target.tree.enable_breakdown()
+    if label == "client":
+        counters, stats = client_stats_counters, client_stats
+    else:
+        counters = StatsStore(CLIENT_COUNTERS_COLUMNS, COUNTERS_CAPACITY)
+        stats = StatsStore(CLIENT_STATS_COLUMNS, 1)
+    client_targets.append({"label": label, "target": target, "counters": counters, "stats": stats})
+# Если целей несколько, они опрашиваются параллельно внутри одного такта
+targets_pool = ThreadPoolExecutor(len(client_targets)) if len(client_targets) > 1 and not args.replay else None
 
-# Функция для сбора и подсчёта общесистемной статистики.
-def collect_general_stats(timestamp):
+# Собственное потребление сборщика: процесс самого скрипта опрашивается на каждом такте так же, как цели,
+# и попадает в поля psutil_self_*. Процесс читается всегда из /proc, так как в --proc-path
+# (например, /host/proc в контейнере) у него может быть другой pid
+self_reader = ProcReader()
+self_target = {
+    "label": "self",
+    "counters": StatsStore(CLIENT_COUNTERS_COLUMNS, COUNTERS_CAPACITY),
+    "stats": StatsStore(CLIENT_STATS_COLUMNS, 1),
+}
+
+# Время этапов каждого такта: общесистемная статистика, каждая цель, подсчёт статистики и обработка
+# файлов мониторинга. Выводится в записи за такт файла JSON Lines и в сводке в конце сбора
+stage_timer = StageTimer()
+
+# Статистика за период считается по ходу сбора: после каждой секунды в period_records добавляется запись
+# за период, который заканчивается на этой секунде. Кроме сумм и средних в запись попадают максимум
+# и перцентили значений тактов за период для cpu, io и net
+period_fields = PERIOD_FIELDS + sum((target_period_fields(label) for label, _, _ in target_specs[1:]), ())
+period_fields += target_period_fields("self")
+period_fields += peak_fields(period_fields)
+period_aggregator = PeriodAggregator(period_iterations, period_fields)
+period_records = StatsStore(period_aggregator.columns, retention_iterations)
+# Показатели с максимумом и перцентилями и объёмы за такт (io и net), которые для них, как в PeriodAggregator,
+# пересчитываются на один базовый интервал
+PEAK_COLUMNS = tuple(
+    dict.fromkeys(f"{source}.{column}" for _, source, column, kind in period_fields if kind in PEAK_KINDS)
+)
+RATE_COLUMNS = frozenset(f"{source}.{column}" for _, source, column, kind in period_fields if kind == "sum")
+# Значения тактов этих показателей и длительность тактов - для максимума и перцентилей по окну файла
+# мониторинга (window_peaks). Хранятся столько же, сколько записи за период
+tick_peaks = StatsStore(PEAK_COLUMNS + ("elapsed",), retention_iterations)
+# Дополнительные периоды при пересчёте (--replay-periods): для каждого свой подсчёт за скользящее окно
+# и свой файл, в который записи пишутся на границах периода
+extra_periods = [
+    {
+        "period": period,
+        "aggregator": PeriodAggregator(period * 1000 // interval_ms, period_fields),
+        "writer": StatisticsWriter(f"{args.statistics}.{period}s", args.batch_size, args.flush_interval),
+    }
+    for period in args.replay_periods
+]
+
+# Файлы, в которые по ходу сбора дописываются результаты: текстовый statistics и, если указан, JSON Lines.
+# При --rotate-size файлы ротируются, поэтому при длительном сборе занимают ограниченное место
+rotation = {"max_bytes": int((args.rotate_size or 0) * 1024 * 1024), "backups": args.rotate_keep}
+output_writers = [StatisticsWriter(args.statistics, args.batch_size, args.flush_interval, args.fsync, **rotation)]
+if args.output:
+    output_writers.append(JsonlWriter(args.output, args.batch_size, args.flush_interval, args.fsync, **rotation))
+
+# Статистика за такт по всем источникам в виде источник.показатель - для свёрток и для агрегатора
+SOURCE_COLUMNS = tuple(f"general.{column}" for column in GENERAL_STATS_COLUMNS) + tuple(
+    f"{label}.{column}" for label in [spec[0] for spec in target_specs] + ["self"] for column in CLIENT_STATS_COLUMNS
+)
+
+# Передача статистики агрегатору (--fleet): статистика за такт по всем источникам вместе с длительностью такта
+# и записи за период. Передача идёт в отдельном потоке, а записи за период попадают к ней
+# как в остальные файлы результатов через output_writers
+fleet = None
+if args.fleet:
+    fleet = FleetSender(
+        fleet_address,
+        {
+            "host": args.fleet_host,
+            "labels": [label for label, _, _ in target_specs],
+            "interval_ms": interval_ms,
+            "monitoring_period": monitoring_period,
+        },
+        ("elapsed",) + SOURCE_COLUMNS,
+        args.batch_size,
+        args.flush_interval,
+        args.fleet_buffer * 1000 // interval_ms,
+    )
+    output_writers.append(fleet)
+
+# Свёртки статистики за такт в минутные и часовые интервалы (--rollups). Минутная свёртка получает каждый такт,
+# часовая - завершённые минутные интервалы. Каждый уровень пишется в свой файл.
+# Перцентили считаются для тех же показателей, что и в записях за период, а объёмы за такт сравниваются
+# в пересчёте на базовый интервал
+rollups = []
+if args.rollups:
+    rollups = [
+        (
+            Rollup(name, resolution * 1000, SOURCE_COLUMNS, PEAK_COLUMNS, RATE_COLUMNS),
+            JsonlWriter(f"{args.rollups}.{name}.jsonl", args.batch_size, args.flush_interval, args.fsync, **rotation),
+        )
+        for name, resolution in ROLLUP_LEVELS
+    ]
+
+# Запись накопленных счётчиков (--record): общесистемные счётчики, счётчики чтения и записи каждого диска
+# (чтобы при пересчёте можно было выбрать другие диски через --disk-pattern) и суммы по каждой цели
+RAW_DISKS = sorted(psutil.disk_io_counters(perdisk=True)) if args.record else []
+RAW_COLUMNS = (
+    GENERAL_COUNTERS_COLUMNS
+    + tuple(f"disk.{disk}.{column}" for disk in RAW_DISKS for column in ("read", "write"))
+    + tuple(f"{spec[0]}.{column}" for spec in target_specs + [("self",)] for column in CLIENT_COUNTERS_COLUMNS)
+)
+raw_writer = None
+if args.record:
+    raw_writer = RawCountersWriter(
+        args.record,
+        RAW_COLUMNS,
+        {
+            "labels": [label for label, _, _ in target_specs],
+            "disks": RAW_DISKS,
+            "interval_ms": interval_ms,
+            "monitoring_period": monitoring_period,
+            # Абсолютный путь: --replay может запускаться из другой рабочей директории
+            "monitoring_files_path": os.path.join(os.path.abspath(monitoring_files_path), ""),
+            "hostname": node(),
+        },
+        args.batch_size,
+        args.flush_interval,
+        args.fsync,
+    )
+
+# Функция для сбора общесистемной статистики. Возвращает накопленные счётчики
+def read_general_counters():
     # cpu_times
     cpu_times = psutil.cpu_times()
     total_cpu_time = sum(vals for vals in cpu_times if vals != "guest" and vals != "guest_nice")
@@ -50,7 +621,6 @@ def collect_general_stats(timestamp):
     net_in_bytes = net_counter.bytes_recv / 1024
     net_out_bytes = net_counter.bytes_sent / 1024
     # io
-    disk_name_pattern = re.compile(r"^[a-z]d[a-z]+$")
     io_counters = psutil.disk_io_counters(perdisk=True, nowrap=True)
     io_counters_block = {
         disk_name: value for disk_name, value in io_counters.items() if disk_name_pattern.match(disk_name)
@@ -64,7 +634,7 @@ def collect_general_stats(timestamp):
     memory_usage_percent = memory_stats.percent
     memory_usage_m = (total_memory - available_memory) / (1024 * 1024)
 
-    general_stats_counters[timestamp] = {
+    counters = {
         "total_cpu_time": total_cpu_time,
         "total_use_cpu_time": total_use_cpu_time,
         "net_in": net_in_bytes,
@@ -74,187 +644,737 @@ def collect_general_stats(timestamp):
         "memory_usage_percent": memory_usage_percent,
         "memory_usage_m": memory_usage_m,
     }
-    # Вызывается функция для расчёта показателей, если длина словаря >= 2
+    # Для --record сохраняются и счётчики каждого диска. Диск, которого нет (например, отключён), записывается как 0
+    for disk in RAW_DISKS:
+        disk_counters = io_counters.get(disk)
+        counters[f"disk.{disk}.read"] = disk_counters.read_bytes / 1024 if disk_counters else 0.0
+        counters[f"disk.{disk}.write"] = disk_counters.write_bytes / 1024 if disk_counters else 0.0
+    return counters
+
+
+# Функция для подсчёта общесистемной статистики по собранным счётчикам
+def collect_general_stats(timestamp, counters):
+    general_stats_counters.append(timestamp, counters)
+    # Вызывается функция для расчёта показателей, если в хранилище >= 2 записей
     if len(general_stats_counters) >= 2:
         calculate_general_stats(timestamp, general_stats_counters, general_stats)
 
 
 # Функция для расчёта статистики по каждому показателю
 def calculate_general_stats(timestamp, general_stats_counters, general_stats):
-    total_cpu_time = general_stats_counters[timestamp]["total_cpu_time"]
-    total_use_cpu_time = general_stats_counters[timestamp]["total_use_cpu_time"]
-    net_in = general_stats_counters[timestamp]["net_in"]
-    net_out = general_stats_counters[timestamp]["net_out"]
-    io_read = general_stats_counters[timestamp]["io_read"]
-    io_write = general_stats_counters[timestamp]["io_write"]
-
-    # Для получение показателей из предыдущей итерации получаем значение предыдущего ключа
-    prev_timestamp = list(general_stats_counters.keys())[-2]
-
-    # Расчёт дельты между показателями из текущей итерации и предыдущей
-    delta_total_cpu_time = total_cpu_time - general_stats_counters[prev_timestamp]["total_cpu_time"]
-    delta_total_use_cpu_time = total_use_cpu_time - general_stats_counters[prev_timestamp]["total_use_cpu_time"]
-    delta_net_in = net_in - general_stats_counters[prev_timestamp]["net_in"]
-    delta_net_out = net_out - general_stats_counters[prev_timestamp]["net_out"]
-    delta_io_read = io_read - general_stats_counters[prev_timestamp]["io_read"]
-    delta_io_write = io_write - general_stats_counters[prev_timestamp]["io_write"]
+    # Показатели из предыдущей итерации - предпоследняя запись в хранилище
+    previous = general_stats_counters.row(-2)
+    general_stats.append(timestamp, general_interval_stats(previous, general_stats_counters.row(-1)))
+
+
+# Расчёт общесистемной статистики за интервал между двумя записями накопленных счётчиков:
+# за такт или за окно из файла мониторинга. Значения могут быть как числами, так и массивами numpy
+def general_interval_stats(previous, current):
+    # Расчёт дельты между показателями на конец интервала и на его начало
+    delta_total_cpu_time = current["total_cpu_time"] - previous["total_cpu_time"]
+    delta_total_use_cpu_time = current["total_use_cpu_time"] - previous["total_use_cpu_time"]
+    delta_net_in = current["net_in"] - previous["net_in"]
+    delta_net_out = current["net_out"] - previous["net_out"]
+    delta_io_read = current["io_read"] - previous["io_read"]
+    delta_io_write = current["io_write"] - previous["io_write"]
 
     # Расчёт показателей в процентах и мегабайтах
     cpu_usage_percent = (delta_total_use_cpu_time / delta_total_cpu_time) * 100
-    memory_usage_percent = general_stats_counters[timestamp]["memory_usage_percent"]
-    memory_usage_m = general_stats_counters[timestamp]["memory_usage_m"]
-
-    # Добавление показателей в словарь general_stats
-    general_stats[timestamp] = {}
-    general_stats[timestamp]["cpu_percent"] = cpu_usage_percent
-    general_stats[timestamp]["net_in"] = delta_net_in
-    general_stats[timestamp]["net_out"] = delta_net_out
-    general_stats[timestamp]["io_read"] = delta_io_read
-    general_stats[timestamp]["io_write"] = delta_io_write
-    general_stats[timestamp]["memory_usage_percent"] = memory_usage_percent
-    general_stats[timestamp]["memory_usage_m"] = memory_usage_m
-
-
-# Функция используется внутри функции calculate_client_total_stat и считает статистику для одного процесса
-# по всем показателям
-def get_clients_stats(proc_pid):
-    try:
-        child_proc = psutil.Process(proc_pid)
-        with child_proc.oneshot():
-            client_times_user = child_proc.cpu_times().user
-            client_times_system = child_proc.cpu_times().system
-            child_io_read_KB = child_proc.io_counters().read_bytes / 1024
-            child_io_write_KB = child_proc.io_counters().write_bytes / 1024
-            child_memory_m = child_proc.memory_info().rss / (1024 * 1024)
-
-            return [client_times_user + client_times_system, child_io_read_KB, child_io_write_KB, child_memory_m]
-    except:
-        print(f"File /proc/{proc_pid}/stat doesn't exist")
-        return [0, 0, 0, 0]
-
-
-# Функция для расчёта суммы по каждому показателю для процесса rubackup_client и всех порожденных им процессов
-def calculate_client_total_stat(list_of_child_pids, timestamp):
-
-    # Функция map вызывает функцию get_clients_stats для каждого pid'а внутри списка list_of_child_pids
-    # и возвращает итератор, состоящий из списков([cpu,io_read,io_write,memory])
-    # со статистикой по каждому показателю для каждого pid'a
-    list_of_stat = map(get_clients_stats, list_of_child_pids)
-    # Функция zip составляет итератор, содержащий статистику, скомпонованную отдельно для каждого показателя
-    list_of_stat_zipped = zip(*list_of_stat)
-    # Функция map возвращает итератор, сотоящий из сумм значений каждого элемента в list_of_stat_zipped
-    total_list = list(map(sum, list_of_stat_zipped))
-    # Значения из списка total_list помещаются в соответствующее место в словаре
-    client_stats_counters[timestamp] = {
-        "client_cpu_time": total_list[0],
-        "client_io_read": total_list[1],
-        "client_io_write": total_list[2],
-        "client_memory": total_list[3],
+    memory_usage_percent = current["memory_usage_percent"]
+    memory_usage_m = current["memory_usage_m"]
+
+    return {
+        "cpu_percent": cpu_usage_percent,
+        "net_in": delta_net_in,
+        "net_out": delta_net_out,
+        "io_read": delta_io_read,
+        "io_write": delta_io_write,
+        "memory_usage_percent": memory_usage_percent,
+        "memory_usage_m": memory_usage_m,
     }
 
 
-def collect_client_stats(timestamp):
-    rubackup_client_pid = pid_and_childs_pids[0]
-    # Нахлждение всех процессов, порожденных процессом rubackup_client, и всех их дочерних процессов
-    for children in psutil.Process(rubackup_client_pid).children(recursive=True):
-        pid_and_childs_pids.append(children.pid)
+# Функция для расчёта суммы по каждому показателю для процессов цели и всех порожденных ими процессов.
+# Для завершившихся дочерних процессов учитываются их последние значения cpu и io.
+# Суммы возвращает target["target"].update(), они передаются в total_list
+def calculate_client_total_stat(target, timestamp, total_list):
+    # Значения из списка total_list помещаются в соответствующие колонки хранилища
+    target["counters"].append(
+        timestamp,
+        {
+            "client_cpu_time": total_list[0],
+            "client_io_read": total_list[1],
+            "client_io_write": total_list[2],
+            "client_memory": total_list[3],
+        },
+    )
+
+
+# Расчёт статистики цели за такт по дельте между показателями из текущей итерации и предыдущей
+def calculate_client_stats(target, timestamp):
+    client_stats_counters = target["counters"]
+    target["stats"].append(
+        timestamp,
+        client_interval_stats(
+            client_stats_counters.row(-2),
+            client_stats_counters.row(-1),
+            general_stats_counters.row(-2),
+            general_stats_counters.row(-1),
+        ),
+    )
+
+
+# Расчёт статистики цели за интервал между двумя записями накопленных счётчиков цели
+# и общесистемных счётчиков на те же моменты
+def client_interval_stats(previous, current, general_previous, general_current):
+    # Расчёт дельты между показателями на конец интервала и на его начало
+    delta_total_cpu_time = general_current["total_cpu_time"] - general_previous["total_cpu_time"]
+    delta_client_cpu_time = current["client_cpu_time"] - previous["client_cpu_time"]
+    delta_client_io_read = current["client_io_read"] - previous["client_io_read"]
+    delta_client_io_write = current["client_io_write"] - previous["client_io_write"]
+    # Расчёт показателей в процентах и мегабайтах
+    client_cpu_usage_percent = (delta_client_cpu_time / delta_total_cpu_time) * 100
+    client_memory_m = current["client_memory"]
+    client_memory_percent = (client_memory_m / general_current["memory_usage_m"]) * 100
+    return {
+        "client_cpu_percent": client_cpu_usage_percent,
+        "client_io_read": delta_client_io_read,
+        "client_io_write": delta_client_io_write,
+        "client_memory_percent": client_memory_percent,
+        "client_memory_m": client_memory_m,
+    }
 
-    calculate_client_total_stat(pid_and_childs_pids, timestamp)
-    # Удаляем идентификаторы всех дочерних процессов из списка
-    del pid_and_childs_pids[1:]
-    # Вызывается функция для расчёта показателей, если длина словаря >= 2
+
+# Длительность последнего такта в базовых интервалах сбора: больше 1 при адаптивной частоте
+# и после пропущенных тактов
+def tick_elapsed():
+    return max(1, (general_stats_counters.timestamp(-1) - general_stats_counters.timestamp(-2)) // interval_ms)
+
+
+def collect_client_stats(timestamp, totals, self_totals):
+    for target, total_list in zip(client_targets, totals):
+        calculate_client_total_stat(target, timestamp, total_list)
+    calculate_client_total_stat(self_target, timestamp, self_totals)
+    # Вызывается функция для расчёта показателей, если в хранилище >= 2 записей
     if len(client_stats_counters) >= 2:
-        total_cpu_time = general_stats_counters[timestamp]["total_cpu_time"]
-        client_total_cpu_time = client_stats_counters[timestamp]["client_cpu_time"]
-        client_io_read = client_stats_counters[timestamp]["client_io_read"]
-        client_io_write = client_stats_counters[timestamp]["client_io_write"]
-        total_memory_m = general_stats[timestamp]["memory_usage_m"]
-
-        # Для получение показателей из предыдущей итерации получаем значение предыдущего ключа
-        prev_timestamp = list(client_stats_counters.keys())[-2]
-        # Расчёт дельты между показателями из текущей итерации и предыдущей
-        delta_total_cpu_time = total_cpu_time - general_stats_counters[prev_timestamp]["total_cpu_time"]
-        delta_client_cpu_time = client_total_cpu_time - client_stats_counters[prev_timestamp]["client_cpu_time"]
-        delta_client_io_read = client_io_read - client_stats_counters[prev_timestamp]["client_io_read"]
-        delta_client_io_write = client_io_write - client_stats_counters[prev_timestamp]["client_io_write"]
-        # Расчёт показателей в процентах и мегабайтах
-        client_cpu_usage_percent = (delta_client_cpu_time / delta_total_cpu_time) * 100
-        client_memory_m = client_stats_counters[timestamp]["client_memory"]
-        client_memory_percent = (client_memory_m / total_memory_m) * 100
-        # Добавление показателей в словарь general_stats
-        client_stats[timestamp] = {}
-        client_stats[timestamp]["client_cpu_percent"] = client_cpu_usage_percent
-        client_stats[timestamp]["client_io_read"] = delta_client_io_read
-        client_stats[timestamp]["client_io_write"] = delta_client_io_write
-        client_stats[timestamp]["client_memory_percent"] = client_memory_percent
-        client_stats[timestamp]["client_memory_m"] = client_memory_m
-
-
-def collect_stats():
-    timestamp = str(datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
-    collect_general_stats(timestamp)
-    collect_client_stats(timestamp)
-
-
-# Подсчёт статистики за указанный период
+        for target in client_targets:
+            calculate_client_stats(target, timestamp)
+        calculate_client_stats(self_target, timestamp)
+        sources = {target["label"]: target["stats"].row() for target in client_targets}
+        sources["self"] = self_target["stats"].row()
+        sources["general"] = general_stats.row()
+        if args.subtract_self:
+            subtract_self_stats(sources["general"], sources["self"])
+        elapsed = tick_elapsed()
+        period_records.append(timestamp, period_aggregator.push(sources, elapsed))
+        values = {f"{source}.{name}": value for source, row in sources.items() for name, value in row.items()}
+        peaks = {
+            column: values[column] / elapsed if column in RATE_COLUMNS else values[column] for column in PEAK_COLUMNS
+        }
+        tick_peaks.append(timestamp, {**peaks, "elapsed": elapsed})
+        for extra in extra_periods:
+            record = extra["aggregator"].push(sources, elapsed)
+            if timestamp % (extra["period"] * 1000) == 0:
+                key = datetime.fromtimestamp(timestamp / 1000).strftime(TIMESTAMP_FORMAT)
+                extra["writer"].write("period", timestamp, {"key": key, "stats": record})
+        if rollups or fleet is not None:
+            push_sources(timestamp, values, elapsed)
+
+
+# Передача статистики такта по всем источникам (источник.показатель) в минутную свёртку и агрегатору
+def push_sources(timestamp, values, elapsed):
+    if rollups:
+        finish_rollup(0, rollups[0][0].push(timestamp, values, elapsed))
+    if fleet is not None:
+        fleet.add_sample(timestamp, [elapsed] + [values[column] for column in SOURCE_COLUMNS])
+
+
+# Запись завершённого интервала свёртки в её файл и передача в свёртку следующего уровня
+def finish_rollup(level, finished):
+    while finished is not None:
+        rollup, writer = rollups[level]
+        start, bucket = finished
+        record = {kind: values for kind, values in bucket.items() if kind != "sketches"}
+        writer.write("rollup", start, {"resolution": rollup.name, **record})
+        level += 1
+        finished = rollups[level][0].merge(start, bucket) if level < len(rollups) else None
+
+
+# Завершение неполных интервалов всех свёрток при остановке сбора
+def flush_rollups():
+    for level, (rollup, _) in enumerate(rollups):
+        finish_rollup(level, rollup.flush())
+
+
+# Вычитание собственного потребления сборщика из общесистемной статистики за такт или за окно.
+# Сетевой трафик процесса не измеряется, поэтому net_in и net_out не меняются
+def subtract_self_stats(general, own):
+    general["cpu_percent"] = np.maximum(0.0, general["cpu_percent"] - own["client_cpu_percent"])
+    general["io_read"] = np.maximum(0.0, general["io_read"] - own["client_io_read"])
+    general["io_write"] = np.maximum(0.0, general["io_write"] - own["client_io_write"])
+    general["memory_usage_percent"] *= np.maximum(0.0, 1 - own["client_memory_m"] / general["memory_usage_m"])
+    general["memory_usage_m"] = np.maximum(0.0, general["memory_usage_m"] - own["client_memory_m"])
+
+
+# Запись за период по окну [start, end] из полей timestamp_before и timestamp_after файла мониторинга.
+# Накопленные счётчики интерполируются на границы окна, поэтому окно не обязано совпадать с тактами сбора,
+# а проценты cpu считаются по отношению дельт за всё окно. edges(store) возвращает значения счётчиков
+# хранилища на начало и конец окна - числа для одного окна или массивы для нескольких.
+# Максимум и перцентили по окну считаются отдельно, по значениям тактов (window_peaks)
+window_fields = tuple(field for field in period_fields if field[3] not in PEAK_KINDS)
+window_peak_fields = tuple(field for field in period_fields if field[3] in PEAK_KINDS)
+window_peak_names = frozenset(field[0] for field in window_peak_fields)
+# Пиковое поле, номер его показателя в PEAK_COLUMNS и вид пика
+window_peak_positions = tuple(
+    (name, PEAK_COLUMNS.index(f"{source}.{column}"), kind) for name, source, column, kind in window_peak_fields
+)
+
+
+def window_record(edges):
+    general_start, general_end = edges(general_stats_counters)
+    sources = {"general": general_interval_stats(general_start, general_end)}
+    for target in client_targets + [self_target]:
+        start, end = edges(target["counters"])
+        sources[target["label"]] = client_interval_stats(start, end, general_start, general_end)
+    if args.subtract_self:
+        subtract_self_stats(sources["general"], sources["self"])
+    return {name: sources[source][column] for name, source, column, _ in window_fields}
+
+
+# Значения тактов из tick_peaks для window_peaks: метки времени, длительности и значения по показателям.
+# Для нескольких окон массивы берутся один раз
+def tick_peak_arrays():
+    return (
+        tick_peaks.timestamps_range(),
+        tick_peaks.column("elapsed"),
+        [tick_peaks.column(column) for column in PEAK_COLUMNS],
+    )
+
+
+# Максимум и перцентили по окну [start, end] файла мониторинга: по тактам, которые пересекаются с окном.
+# Такт с меткой t охватывает (t - elapsed * интервал, t], значения взвешиваются по длительности пересечения
+# с окном, поэтому среднее по окну всегда лежит между минимумом и максимумом тактов окна.
+# Если такты окна уже (или ещё) не хранятся, возвращается пустой словарь - пиковых полей в записи не будет
+def window_peaks(arrays, start, end):
+    timestamps, elapsed, columns = arrays
+    # Границы окна округляются до целых миллисекунд, как метки тактов, иначе searchsorted приводит
+    # к float весь массив меток на каждый вызов
+    first = int(np.searchsorted(timestamps, math.floor(start), side="right"))
+    last = int(np.searchsorted(timestamps, math.ceil(end), side="left"))
+    if last >= len(timestamps) or timestamps[first] - elapsed[first] * interval_ms > start:
+        return {}
+    ends = timestamps[first : last + 1]
+    weights = (np.minimum(ends, end) - np.maximum(ends - elapsed[first : last + 1] * interval_ms, start)) / interval_ms
+    peaks = weighted_peaks(np.column_stack([values[first : last + 1] for values in columns]), weights)
+    return {name: float(peaks[kind][position]) for name, position, kind in window_peak_positions}
+
+
+# Опрос собственного процесса. Вызывается после снимков, чтобы в его счётчики попала и работа по сбору за такт
+def sample_self():
+    with stage_timer.stage("self"):
+        return self_reader.sample(os.getpid())[1]
+
+
+# Подсчёт статистики по снимкам системы и процессов за такт. Возвращает расхождение во времени между снимками
+# Если общее время cpu с прошлого такта не изменилось (интервал близок к шагу счётчиков), проценты cpu
+# посчитать нельзя: такт пропускается, и следующий такт считается от предыдущих счётчиков
+def store_stats(timestamp, general_snapshot, target_snapshots, self_totals):
+    counters, general_time = general_snapshot
+    totals = [target_totals for target_totals, _ in target_snapshots]
+    if general_stats_counters.total and counters["total_cpu_time"] == general_stats_counters.get("total_cpu_time"):
+        return snapshot_skew(general_time, [target_time for _, target_time in target_snapshots])
+    if raw_writer is not None:
+        record_raw_counters(timestamp, counters, totals, self_totals)
+    with stage_timer.stage("aggregation"):
+        collect_general_stats(timestamp, counters)
+        collect_client_stats(timestamp, totals, self_totals)
+    return snapshot_skew(general_time, [target_time for _, target_time in target_snapshots])
+
+
+# Запись накопленных счётчиков такта для --record
+def record_raw_counters(timestamp, counters, totals, self_totals):
+    values = dict(counters)
+    for target, target_totals in zip(client_targets + [self_target], totals + [self_totals]):
+        for column, value in zip(CLIENT_COUNTERS_COLUMNS, target_totals):
+            values[f"{target['label']}.{column}"] = value
+    raw_writer.write(timestamp, values)
+
+
+# Функции сбора с замером времени этапов
+read_general = stage_timer.wrap("general", read_general_counters)
+read_targets = [
+    stage_timer.wrap(f"target:{target['label']}", target["target"].update)
+    for target in client_targets
+    if target["target"] is not None
+]
+
+
+# Последовательный сбор статистики за такт. Процессы нескольких целей обходятся параллельно в пуле потоков
+def collect_stats(timestamp):
+    general_snapshot = timed_call(read_general)
+    if targets_pool is None:
+        target_snapshots = [timed_call(read_targets[0])]
+    else:
+        target_snapshots = list(targets_pool.map(timed_call, read_targets))
+    return store_stats(timestamp, general_snapshot, target_snapshots, sample_self())
+
+
+# Передача записи всем файлам результатов
+def write_output(kind, timestamp, record):
+    for writer in output_writers:
+        writer.write(kind, timestamp, record)
+
+
+# Сервер с текущей статистикой в формате OpenMetrics (--metrics-port). Ответ готовится один раз за такт
+# в render_metrics, а запросы только отдают готовый ответ из потоков сервера
+exporter = None
+if args.metrics_port is not None:
+    exporter = MetricsExporter(args.metrics_host, args.metrics_port)
+# Расхождение показателей RuBackup с psutil (rb - psutil) по последнему сопоставленному файлу мониторинга
+rb_deltas = {}
+# Показатели за такт: имя метрики, колонка общесистемной статистики, колонка статистики цели и описание
+TICK_METRICS = (
+    ("cpu_percent", "cpu_percent", "client_cpu_percent", "Загрузка cpu за такт, %"),
+    ("io_read_kilobytes", "io_read", "client_io_read", "Прочитано с дисков за такт, КБ"),
+    ("io_write_kilobytes", "io_write", "client_io_write", "Записано на диски за такт, КБ"),
+    ("memory_percent", "memory_usage_percent", "client_memory_percent", "Используемая память, %"),
+    ("memory_megabytes", "memory_usage_m", "client_memory_m", "Используемая память, МБ"),
+    ("net_in_kilobytes", "net_in", None, "Принято по сети за такт, КБ"),
+    ("net_out_kilobytes", "net_out", None, "Отправлено по сети за такт, КБ"),
+)
+
+
+def update_rb_deltas(stats):
+    if exporter is None:
+        return
+    for name, value in stats.items():
+        rb_value = stats.get(rb_counterpart(name)) if name.startswith("psutil_") else None
+        if isinstance(rb_value, (int, float)) and not isinstance(rb_value, bool):
+            rb_deltas[name] = rb_value - value
+
+
+def render_metrics(timestamp):
+    sources = [("general", general_stats)] + [(target["label"], target["stats"]) for target in client_targets]
+    sources.append(("self", self_target["stats"]))
+    # Источники, для которых есть статистика за этот такт
+    current = [(label, store) for label, store in sources if store.total and store.timestamp() == timestamp]
+    families = []
+    for name, general_column, client_column, help_text in TICK_METRICS:
+        samples = []
+        for label, store in current:
+            column = general_column if label == "general" else client_column
+            if column is not None:
+                samples.append(({"source": label}, store.get(column)))
+        families.append((f"test_monitoring_{name}", "gauge", help_text, samples))
+    period = period_records.row() if period_records.total else {}
+    families += [
+        (
+            "test_monitoring_period",
+            "gauge",
+            "Статистика за последний период мониторинга по полям файла statistics",
+            [({"field": name}, value) for name, value in period.items()],
+        ),
+        (
+            "test_monitoring_rb_delta",
+            "gauge",
+            "Расхождение показателя RuBackup с psutil (rb - psutil) по последнему файлу мониторинга",
+            [({"field": name}, value) for name, value in rb_deltas.items()],
+        ),
+        ("test_monitoring_ticks", "counter", "Выполненные такты сбора", [({}, scheduler.ticks)]),
+        ("test_monitoring_missed_ticks", "counter", "Пропущенные такты сбора", [({}, scheduler.missed)]),
+        ("test_monitoring_tick_lateness_seconds", "gauge", "Опоздание такта, с", [({}, scheduler.lateness)]),
+        (
+            "test_monitoring_snapshot_skew_seconds",
+            "gauge",
+            "Расхождение во времени снимков системы и процессов, с",
+            [({}, tick_stats.get("skew"))],
+        ),
+        (
+            "test_monitoring_interval_seconds",
+            "gauge",
+            "Текущий интервал сбора, с",
+            [({}, scheduler.stride * interval_ms / 1000)],
+        ),
+        (
+            "test_monitoring_stage_seconds",
+            "gauge",
+            "Время этапа сбора на последнем такте, с",
+            [({"stage": stage}, seconds) for stage, seconds in stage_timer.last.items()],
+        ),
+        ("test_monitoring_last_tick_timestamp_seconds", "gauge", "Время последнего такта", [({}, timestamp / 1000)]),
+    ]
+    return render_openmetrics(families)
+
+
+# Статистика за такт для файла JSON Lines: накопленные счётчики и рассчитанные по ним значения
+def write_sample(timestamp):
+    if not args.output:
+        return
+    sample = {
+        "lateness": tick_stats.get("lateness"),
+        "missed": int(tick_stats.get("missed")),
+        "skew": tick_stats.get("skew"),
+        "stages": dict(stage_timer.last),
+        "general_counters": general_stats_counters.row(),
+        "self_counters": self_target["counters"].row(),
+    }
+    if general_stats.total and general_stats.timestamp() == timestamp:
+        sample["general"] = general_stats.row()
+    for target in client_targets:
+        label = target["label"]
+        sample[f"{label}_counters"] = target["counters"].row()
+        if target["stats"].total and target["stats"].timestamp() == timestamp:
+            sample[label] = target["stats"].row()
+    if self_target["stats"].total and self_target["stats"].timestamp() == timestamp:
+        sample["self"] = self_target["stats"].row()
+    write_output("sample", timestamp, sample)
+
+
+# Объединение файла мониторинга с записью за период. Окно периода берётся из полей timestamp_before
+# и timestamp_after файла, счётчики на его границах интерполируются за O(log n), а максимум и перцентили
+# считаются по тактам окна.
+# Если границ в файле нет или окно начинается раньше сохранённых счётчиков (например, до начала сбора),
+# используется запись за период тактов, которая заканчивается на секунде из имени файла.
+# Возвращает False, если файл нужно обработать позже: счётчики на конец окна ещё не собраны
+# или файл ещё не дописан. Посторонние файлы, файлы, для которых записи нет, и файлы, которые не стали
+# корректным JSON за время хранения записей (--retention), пропускаются
+def join_monitoring_file(file_name):
+    timestamp = monitoring_file_timestamp(file_name)
+    if timestamp is None:
+        return True
+    try:
+        monitoring_data = parse_monitoring_file(monitoring_files_path + file_name)
+    except JSONDecodeError as e:
+        # Файл может быть ещё не дописан. Если он так и не стал корректным, пока хранились счётчики за его время,
+        # сопоставить его уже не с чем, и он пропускается, а не перечитывается на каждом такте
+        if general_stats_counters.total and timestamp < general_stats_counters.timestamp(0):
+            print(f"\nФайл мониторинга {file_name} пропущен: {e}")
+            return True
+        return False
+    except (OSError, ValueError) as e:
+        # Файл удалён или переименован при ротации, является директорией или записан не в UTF-8
+        print(f"\nФайл мониторинга {file_name} пропущен: {e}")
+        return True
+    start = rb_timestamp(monitoring_data.get("rb_timestamp_before"))
+    end = rb_timestamp(monitoring_data.get("rb_timestamp_after"))
+    window = None
+    if start is not None and end is not None and start < end:
+        if not general_stats_counters.total or end > general_stats_counters.timestamp():
+            return False
+        if general_stats_counters.interpolate(start) is not None:
+            window = window_record(lambda store: (store.interpolate(start), store.interpolate(end)))
+    index = period_records.find(timestamp)
+    if window is None and index is None:
+        return period_records.total > 0 and timestamp < period_records.timestamp()
+    record = period_records.row(index) if index is not None else {}
+    if window is not None:
+        # Пики записи за период тактов относятся к другому окну и заменяются пиками тактов окна файла
+        record = without_peaks(record)
+        record.update(window)
+        record.update(window_peaks(tick_peak_arrays(), start, end))
+    record.update(monitoring_data)
+    write_output("period", timestamp, {"key": file_name, "stats": record})
+    update_rb_deltas(record)
+    return True
+
+
+def without_peaks(record):
+    return {name: value for name, value in record.items() if name not in window_peak_names}
+
+
+# Обработка новых файлов мониторинга во время сбора. Результаты сразу дописываются в файлы,
+# поэтому при аварийном завершении уже сопоставленные записи не теряются
+def process_monitoring_files():
+    with stage_timer.stage("ingest"):
+        ingest_monitoring_files()
+
+
+def ingest_monitoring_files():
+    global watcher
+    if watcher is None:
+        if not os.path.isdir(monitoring_files_path):
+            return
+        # Директория появилась во время сбора: файлы, созданные в ней до наблюдателя, он не вернёт
+        watcher = MonitoringWatcher(monitoring_files_path, args.watch)
+        pending_files.update(os.listdir(monitoring_files_path))
+        print(f"\nДиректория {monitoring_files_path} появилась, файлы мониторинга сопоставляются во время сбора")
+    pending_files.update(watcher.poll())
+    for file_name in sorted(pending_files):
+        if join_monitoring_file(file_name):
+            pending_files.discard(file_name)
+
+
+# Объединение файлов мониторинга с записями за период после окончания сбора.
+# Файлы загружаются все сразу параллельно, с кэшем уже разобранных файлов. Окна из timestamp_before
+# и timestamp_after всех файлов считаются векторно: счётчики интерполируются на границы окон через np.interp.
+# Для файлов без границ окна или с окном за пределами сохранённых счётчиков запись за период тактов
+# ищется двоичным поиском по времени из имени файла
 def gather_period_stats():
-    monitoring_files = listdir(monitoring_files_path)
-    period_stats = {}
-    keys_list = list(general_stats.keys())
-    for key in keys_list:
-        # Поиск ключей в списке со статистикой, которые совпадают с имеющимися файлами мониторинга
-        if key in monitoring_files:
-            end = keys_list.index(key) + 1
-            # max 0 установлен, чтобы не полуичлся отрицательный индекс в тех случаях, когда
-            # имя найденного файла совпадает с тем ключом в словаре, индекс которого < monitoring_period
-            # Таким образом, значения первого ключа в словаре period_stats нужно игнорировать
-            start = max(0, end - monitoring_period)
-            values_general = [general_stats[k] for k in keys_list[start:end]]
-            values_client = [client_stats[k] for k in keys_list[start:end]]
-            period_stats[key] = {}
-            period_stats[key]["psutil_general_cpu"] = (
-                sum([value["cpu_percent"] for value in values_general]) / monitoring_period
-            )
-            period_stats[key]["psutil_general_net_usage_r"] = sum([value["net_in"] for value in values_general])
-            period_stats[key]["psutil_general_net_usage_w"] = sum([value["net_out"] for value in values_general])
-            period_stats[key]["psutil_general_io_usage_r"] = sum([value["io_read"] for value in values_general])
-            period_stats[key]["psutil_general_io_usage_w"] = sum([value["io_write"] for value in values_general])
-            period_stats[key]["psutil_general_ram_usage_%"] = general_stats[key]["memory_usage_percent"]
-            period_stats[key]["psutil_general_ram_usage_m"] = general_stats[key]["memory_usage_m"]
-            period_stats[key]["psutil_client_cpu"] = (
-                sum([value["client_cpu_percent"] for value in values_client]) / monitoring_period
-            )
-            period_stats[key]["psutil_client_io_usage_r"] = sum([value["client_io_read"] for value in values_client])
-            period_stats[key]["psutil_client_io_usage_w"] = sum([value["client_io_write"] for value in values_client])
-            period_stats[key]["psutil_client_ram_usage_%"] = client_stats[key]["client_memory_percent"]
-            period_stats[key]["psutil_client_ram_usage_m"] = client_stats[key]["client_memory_m"]
-
-            get_monitoring_data(monitoring_files_path, key, period_stats)
-    # Запись подсчитанной статистики за период в файл statistics
-    with open("statistics", "w") as stat_file:
-        for key_name, key_value in period_stats.items():
-            stat_file.write(f"{key_name}\n")
-            for stat_name, stat_value in key_value.items():
-                stat_file.write(f"{stat_name} {stat_value}\n")
-            stat_file.write(f"---------\n")
-
-
-# Функция для парсинга и записи данных из файла мониторинга в общий словарь со ставтистикой за период
-def get_monitoring_data(monitoring_files_path, key, period_stats):
-    with open(monitoring_files_path + key, "r") as j:
-        monitoring_file_data = load(j)
-        for stat_name in monitoring_file_data:
-            # Изменяем имена параметров general и client_ram_usage, чтобы не было совпадающих шаблонов в именах параметров
-            # Для всех параметров из файла мониторинга добавляем префикс rb_, для последующей обработки при построении графика
-            if stat_name == "general_ram_usage" or stat_name == "client_ram_usage":
-                period_stats[key][f"rb_{stat_name}_%"] = monitoring_file_data[stat_name]
+    with stage_timer.stage("ingest"):
+        join_period_stats()
+
+
+def join_period_stats():
+    table = load_monitoring_files(monitoring_files_path, args.monitoring_cache)
+    names = [name for name in table if name != "timestamp"]
+    file_timestamps = table["timestamp"]
+    count = len(file_timestamps)
+    starts = rb_timestamps(table["rb_timestamp_before"]) if "rb_timestamp_before" in table else np.full(count, np.nan)
+    ends = rb_timestamps(table["rb_timestamp_after"]) if "rb_timestamp_after" in table else np.full(count, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        windows = window_record(lambda store: (store.interpolate_many(starts), store.interpolate_many(ends)))
+    # Окно подходит, если счётчики есть на обеих границах и окно не пустое
+    in_window = (starts < ends) & ~np.isnan(windows[window_fields[0][0]])
+    # Записи за период с метками времени из имён файлов
+    indexes, found = join_table({"timestamp": period_records.timestamps_range()}, file_timestamps)
+    arrays = tick_peak_arrays()
+    for row in (in_window | found).nonzero()[0].tolist():
+        timestamp = int(file_timestamps[row])
+        period_stats = period_records.row(int(indexes[row])) if found[row] else {}
+        if in_window[row]:
+            period_stats = without_peaks(period_stats)
+            period_stats.update({name: float(values[row]) for name, values in windows.items()})
+            period_stats.update(window_peaks(arrays, starts[row], ends[row]))
+        for name in names:
+            value = table[name][row].item()
+            # Параметры, которых не было в этом файле мониторинга, пропускаются
+            if value == "" or value != value:
+                continue
+            period_stats[name] = value
+        key = datetime.fromtimestamp(timestamp / 1000).strftime(TIMESTAMP_FORMAT)
+        write_output("period", timestamp, {"key": key, "stats": period_stats})
+        update_rb_deltas(period_stats)
+
+
+# Файлы мониторинга, которые появились, но ещё не сопоставлены с записью за период.
+# Если директории мониторинга ещё нет, она проверяется на каждом такте, и наблюдатель создаётся, когда она появится:
+# хранилища рассчитаны на --retention секунд, поэтому откладывать сопоставление до конца сбора нельзя
+pending_files = set()
+watcher = None
+watching = args.watch != "off"
+if watching:
+    if os.path.isdir(monitoring_files_path):
+        watcher = MonitoringWatcher(monitoring_files_path, args.watch)
+    else:
+        print(f"Директория {monitoring_files_path} не найдена, файлы будут сопоставляться, когда она появится")
+
+scheduler = TickScheduler(interval_ms)
+# При адаптивной частоте количество тактов заранее неизвестно, поэтому сбор идёт до метки времени
+collection_end = None if iterations is None else scheduler.next_timestamp() + iterations * interval_ms
+
+
+# Активность на такте для адаптивной частоты сбора: cpu или io цели client либо сетевой трафик узла выше порогов.
+# io и сеть сравниваются в КБ/с, поэтому пороги не зависят от длительности такта. Пока статистики за такт нет,
+# узел считается активным
+def is_busy(timestamp):
+    if not client_stats.total or client_stats.timestamp() != timestamp:
+        return True
+    seconds = tick_elapsed() * interval_ms / 1000
+    general = general_stats.row()
+    client = client_stats.row()
+    return (
+        client["client_cpu_percent"] >= args.busy_cpu
+        or (client["client_io_read"] + client["client_io_write"]) / seconds >= args.busy_io
+        or (general["net_in"] + general["net_out"]) / seconds >= args.busy_net
+    )
+
+
+# Процессы целей с наибольшим потреблением за период (--top) в записи top файла JSON Lines.
+# Вызывается на границах периода мониторинга. Процессы выбираются через heapq.nlargest за O(n log N),
+# без сортировки всех процессов дерева. Доля cpu считается от cpu всех процессов цели за период
+def write_top(timestamp):
+    record = {"key": datetime.fromtimestamp(timestamp / 1000).strftime(TIMESTAMP_FORMAT)}
+    for target in client_targets:
+        usage = target["target"].tree.take_breakdown()
+        total_cpu = sum(values[1] for values in usage.values())
+
+        def entry(key):
+            name, cpu, io_read, io_write, memory = usage[key]
+            return {
+                "pid": key[0],
+                "name": name,
+                "cpu_s": cpu,
+                "cpu_share_%": cpu / total_cpu * 100 if total_cpu > 0 else 0.0,
+                "io_read": io_read,
+                "io_write": io_write,
+                "memory_m": memory,
+            }
+
+        record[target["label"]] = {
+            "processes": len(usage),
+            "cpu": [entry(key) for key in heapq.nlargest(args.top, usage, key=lambda key: usage[key][1])],
+            "io": [entry(key) for key in heapq.nlargest(args.top, usage, key=lambda key: sum(usage[key][2:4]))],
+        }
+    write_output("top", timestamp, record)
+
+
+# Продолжать ли сбор: собрано меньше необходимого количества тактов или сбор без ограничения (--daemon)
+def collecting():
+    if adaptive is not None and collection_end is not None:
+        return scheduler.next_timestamp() < collection_end
+    return iterations is None or general_stats.total < iterations
+
+
+# Учёт такта после сбора: статистика такта, запись в файлы и вывод оставшегося времени
+def finish_tick(timestamp, missed, skew):
+    tick_stats.append(timestamp, {"lateness": scheduler.lateness, "missed": scheduler.missed - missed, "skew": skew})
+    write_sample(timestamp)
+    if exporter is not None:
+        with stage_timer.stage("metrics"):
+            exporter.publish(render_metrics(timestamp))
+    if args.top and timestamp % (monitoring_period * 1000) == 0:
+        with stage_timer.stage("top"):
+            write_top(timestamp)
+    if adaptive is not None:
+        stride = adaptive.update(is_busy(timestamp))
+        if stride != scheduler.stride:
+            scheduler.set_stride(stride)
+    if iterations is None:
+        print(f"\rСобрано {general_stats.total} тактов", end="")
+    elif adaptive is not None:
+        remaining = (collection_end - scheduler.next_timestamp()) // 1000
+        print(f"\rОсталось {remaining} секунд, интервал сбора {scheduler.stride * interval_ms} мс  ", end="")
+    else:
+        print(f"\rОсталось {(iterations - general_stats.total) * interval_ms // 1000} секунд", end="")
+
+
+def run_collection():
+    while collecting():
+        # Ожидание дедлайна следующего такта. Метка времени такта номинальная, поэтому задержка сбора
+        # не сдвигает её и не приводит к повторяющимся или пропущенным меткам
+        missed = scheduler.missed
+        timestamp = scheduler.wait()
+        skew = collect_stats(timestamp)
+        finish_tick(timestamp, missed, skew)
+        if watching:
+            process_monitoring_files()
+
+
+# Пересчёт статистики по записанным накопленным счётчикам (--replay) через те же функции подсчёта,
+# что и при сборе, без ожидания тактов. Записи читаются частями, чтобы не держать в памяти весь файл
+# в виде объектов Python. Если записаны счётчики каждого диска, общесистемный io суммируется заново
+# по дискам, подходящим под --disk-pattern
+REPLAY_CHUNK = 65536
+
+
+def run_replay():
+    disks = [disk for disk in replay_metadata["disks"] if disk_name_pattern.match(disk)]
+    target_columns = [
+        [f"{target['label']}.{column}" for column in CLIENT_COUNTERS_COLUMNS]
+        for target in client_targets + [self_target]
+    ]
+    for start in range(0, len(replay_records), REPLAY_CHUNK):
+        chunk = replay_records[start : start + REPLAY_CHUNK]
+        columns = {name: chunk[name].tolist() for name in chunk.dtype.names}
+        if replay_metadata["disks"]:
+            columns["io_read"] = sum((chunk[f"disk.{disk}.read"] for disk in disks), np.zeros(len(chunk))).tolist()
+            columns["io_write"] = sum((chunk[f"disk.{disk}.write"] for disk in disks), np.zeros(len(chunk))).tolist()
+        for i, timestamp in enumerate(columns["timestamp"]):
+            counters = {column: columns[column][i] for column in GENERAL_COUNTERS_COLUMNS}
+            totals = [[columns[column][i] for column in names] for names in target_columns]
+            store_stats(timestamp, (counters, 0.0), [(target_totals, 0.0) for target_totals in totals[:-1]], totals[-1])
+            tick_stats.append(timestamp, {"lateness": 0.0, "missed": 0, "skew": 0.0})
+            write_sample(timestamp)
+        print(f"\rПересчитано {min(start + REPLAY_CHUNK, len(replay_records))} из {len(replay_records)} тактов", end="")
+
+
+# Сбор на asyncio: файлы мониторинга обрабатываются одновременно со снимками, а не после них
+async def run_collection_async():
+    collector = AsyncCollector(read_general, read_targets, process_monitoring_files if watching else None)
+    try:
+        while collecting():
+            missed = scheduler.missed
+            timestamp = await scheduler.wait_async()
+            general_snapshot, target_snapshots = await collector.snapshot()
+            skew = store_stats(timestamp, general_snapshot, target_snapshots, sample_self())
+            finish_tick(timestamp, missed, skew)
+    finally:
+        collector.close()
+
+
+def main():
+    if exporter is not None:
+        host, port = exporter.address
+        print(f"Статистика в формате OpenMetrics: http://{host}:{port}/metrics")
+    if fleet is not None:
+        print(f"Статистика передаётся агрегатору {args.fleet} от узла {args.fleet_host}")
+    if args.replay:
+        print(f"Пересчёт {iterations} тактов ({seconds} секунд сбора) из {args.replay}")
+    elif args.daemon:
+        print("Сбор статистики до остановки (SIGTERM или Ctrl-C)")
+        # SIGTERM останавливает сбор так же, как Ctrl-C: с завершением свёрток и сбросом записей в файлы
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    else:
+        print(f"{seconds} секунд необходимо для сбора статистики")
+    # Потребление сборщика за всё время сбора: cpu и io считаются по разнице счётчиков в начале и в конце
+    _, self_start = self_reader.sample(os.getpid())
+    start_time = time.monotonic()
+    try:
+        try:
+            if args.replay:
+                run_replay()
+            elif args.engine == "async":
+                asyncio.run(run_collection_async())
             else:
-                period_stats[key][f"rb_{stat_name}"] = monitoring_file_data[stat_name]
+                run_collection()
+        except KeyboardInterrupt:
+            if not args.daemon:
+                raise
+            print("\nСбор остановлен")
+
+        if watcher is not None:
+            # Файлы, появившиеся за последнюю секунду сбора
+            process_monitoring_files()
+        elif not watching and os.path.isdir(monitoring_files_path):
+            gather_period_stats()
+        else:
+            print(f"\nДиректория {monitoring_files_path} не найдена, записи за период не сопоставлены с файлами")
+    finally:
+        # Накопленные записи сбрасываются в файлы и при прерывании сбора (например, Ctrl-C)
+        flush_rollups()
+        for writer in output_writers + [extra["writer"] for extra in extra_periods] + [writer for _, writer in rollups]:
+            writer.close()
+        if raw_writer is not None:
+            raw_writer.close()
+        if watcher is not None:
+            watcher.close()
+        if exporter is not None:
+            exporter.close()
+
+    _, self_end = self_reader.sample(os.getpid())
+    elapsed = time.monotonic() - start_time
+    self_reader.close()
+    for target in client_targets:
+        if target["target"] is not None:
+            target["target"].close()
+    if targets_pool is not None:
+        targets_pool.shutdown()
 
+    if args.replay:
+        print(f"\nПересчитано за {elapsed:.3f} с, в {seconds / elapsed:.0f} раз быстрее сбора")
+    elif scheduler.ticks:
+        print(
+            f"\nТактов: {scheduler.ticks}, пропущено: {scheduler.missed}, "
+            f"опоздание среднее: {scheduler.total_lateness / scheduler.ticks * 1000:.3f} мс, "
+            f"максимальное: {scheduler.max_lateness * 1000:.3f} мс, "
+            f"расхождение снимков системы и процессов максимальное: {tick_stats.column('skew').max() * 1000:.3f} мс"
+        )
+    print(
+        f"Потребление сборщика: cpu {self_end[0] - self_start[0]:.3f} с "
+        f"({(self_end[0] - self_start[0]) / elapsed * 100:.2f}% одного ядра), "
+        f"io чтение {self_end[1] - self_start[1]:.0f} КБ, запись {self_end[2] - self_start[2]:.0f} КБ, "
+        f"память {self_end[3]:.1f} МБ"
+    )
+    if fleet is not None:
+        print(
+            f"Агрегатору передано записей: {fleet.delivered}, не передано: {fleet.pending_rows}, "
+            f"отброшено при переполнении: {fleet.dropped}, подключений: {fleet.reconnects}"
+        )
+    print("Время этапов:")
+    for line in stage_timer.summary():
+        print(f"  {line}")
 
-while len(general_stats) < iterations:
-    collect_stats()
-    print(f"\rОсталось {iterations - len(general_stats)} секунд", end="")
-    sleep(1)
 
-gather_period_stats()
+# При импорте (например, из benchmark.py) сбор не запускается
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+# Константы inotify из <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Заголовок struct inotify_event: wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+# Отслеживание новых файлов в директории мониторинга RuBackup.
+# По возможности используется inotify (через libc), иначе директория периодически перечитывается,
+# причём только тогда, когда изменилось её время модификации.
+# Метод poll не блокируется и возвращает имена файлов, появившихся с прошлого вызова.
+# Файлы, которые уже лежали в директории на момент создания наблюдателя, не возвращаются.
+class MonitoringWatcher:
+    def __init__(self, path, mode="auto"):
+        if mode not in ("auto", "inotify", "poll"):
+            raise ValueError(f"Неизвестный режим наблюдения: {mode}")
+        self.path = path
+        self.mode = None
+        self._fd = None
+        if mode in ("auto", "inotify"):
+            try:
+                self._fd = self._inotify_open(path)
+                self.mode = "inotify"
+            except OSError as e:
+                if mode == "inotify":
+                    raise
+                print(f"inotify недоступен ({e}), используется периодическое чтение директории")
+        if self._fd is None:
+            self.mode = "poll"
+            self._known = set(os.listdir(path))
+            self._mtime = os.stat(path).st_mtime_ns
+
+    @staticmethod
+    def _inotify_open(path):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc не найдена")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("libc не поддерживает inotify")
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno), path)
+        return fd
+
+    def poll(self):
+        if self.mode == "inotify":
+            return self._read_events()
+        return self._rescan()
+
+    def _read_events(self):
+        new_files = []
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return new_files
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, name_len = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = buffer[offset : offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if name:
+                    new_files.append(os.fsdecode(name))
+
+    def _rescan(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return []
+        self._mtime = mtime
+        names = set(os.listdir(self.path))
+        new_files = sorted(names - self._known)
+        self._known = names
+        return new_files
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+from collections import deque
+import numpy as np
+from quantile_sketch import QuantileSketch
+
+# Описание полей записи за период: имя поля, источник (general_stats или client_stats), показатель и способ свёртки.
+# "mean" - сумма за окно, делённая на количество тактов в периоде, "sum" - сумма за окно,
+# "last" - значение последнего такта окна. Способы свёртки из PEAK_KINDS (max, p50, p95, p99) -
+# максимум и перцентили значений тактов окна, они добавляются функцией peak_fields.
+# Порядок полей совпадает с порядком записи в файл statistics
+PERIOD_FIELDS = (
+    ("psutil_general_cpu", "general", "cpu_percent", "mean"),
+    ("psutil_general_net_usage_r", "general", "net_in", "sum"),
+    ("psutil_general_net_usage_w", "general", "net_out", "sum"),
+    ("psutil_general_io_usage_r", "general", "io_read", "sum"),
+    ("psutil_general_io_usage_w", "general", "io_write", "sum"),
+    ("psutil_general_ram_usage_%", "general", "memory_usage_percent", "last"),
+    ("psutil_general_ram_usage_m", "general", "memory_usage_m", "last"),
+    ("psutil_client_cpu", "client", "client_cpu_percent", "mean"),
+    ("psutil_client_io_usage_r", "client", "client_io_read", "sum"),
+    ("psutil_client_io_usage_w", "client", "client_io_write", "sum"),
+    ("psutil_client_ram_usage_%", "client", "client_memory_percent", "last"),
+    ("psutil_client_ram_usage_m", "client", "client_memory_m", "last"),
+)
+PERIOD_COLUMNS = tuple(field[0] for field in PERIOD_FIELDS)
+# Пиковые значения за период: точный максимум и перцентили
+PEAK_KINDS = ("max", "p50", "p95", "p99")
+# Перцентили и соответствующие им доли для QuantileSketch.quantiles
+PEAK_QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+# Поля записи за период для дополнительной отслеживаемой цели: те же поля, что и для rubackup_client,
+# но с меткой цели вместо client в имени поля и с источником статистики под этой меткой
+def target_period_fields(label):
+    return tuple(
+        (name.replace("psutil_client_", f"psutil_{label}_"), label, column, kind)
+        for name, source, column, kind in PERIOD_FIELDS
+        if source == "client"
+    )
+
+
+# Поля с максимумом и перцентилями значений тактов за период для полей, которые суммируются или усредняются
+# за окно (cpu, io и net): psutil_general_cpu_max, psutil_general_cpu_p50 и т.д.
+def peak_fields(fields):
+    return tuple(
+        (f"{name}_{kind}", source, column, kind)
+        for name, source, column, field_kind in fields
+        if field_kind in ("mean", "sum")
+        for kind in PEAK_KINDS
+    )
+
+
+# Точные максимум и перцентили значений тактов с весами - длительностью тактов в базовых интервалах сбора.
+# values - массив значений тактов или матрица (такты x показатели), тогда пики считаются для каждого
+# показателя за одну сортировку. Ранг перцентиля считается так же, как в QuantileSketch.quantiles:
+# доля от (суммарный вес - 1), поэтому при единичных весах результат совпадает с перцентилями записи за период
+def weighted_peaks(values, weights):
+    order = np.argsort(values, axis=0, kind="stable")
+    ordered = np.take_along_axis(values, order, axis=0)
+    cumulative = np.cumsum(weights[order], axis=0)
+    peaks = {"max": ordered[-1]}
+    for kind, share in PEAK_QUANTILES.items():
+        index = np.minimum((cumulative <= share * (cumulative[-1] - 1)).sum(axis=0), len(values) - 1)
+        peaks[kind] = np.take_along_axis(ordered, index[np.newaxis], axis=0)[0]
+    return peaks
+
+
+# Инкрементальный подсчёт статистики за скользящее окно длительностью period базовых интервалов сбора
+# (при интервале сбора 1 секунда - за period последних секунд).
+# Такт может длиться несколько базовых интервалов (elapsed), например при адаптивной частоте сбора
+# или после пропущенных тактов. Такты выходят из окна по суммарной длительности, а не по количеству,
+# средние взвешиваются по длительности тактов, а перцентили считаются по длительности, которую занимало значение.
+# При постоянном интервале (elapsed = 1) окно состоит ровно из period последних тактов.
+# Для показателей, которые суммируются за окно, хранятся текущие суммы: при добавлении такта его значение
+# прибавляется, а значение такта, вышедшего из окна, вычитается. Поэтому запись за период, заканчивающийся
+# на текущем такте, готова сразу после добавления такта и стоит O(1).
+# Пока окно не заполнено, суммируются имеющиеся такты, а средние всё равно делятся на period -
+# так же, как это делалось при подсчёте в конце сбора.
+# Для перцентилей (peak_fields) значения тактов окна хранятся в QuantileSketch: значение такта добавляется,
+# а значение вышедшего из окна такта удаляется, поэтому память не зависит от длины периода.
+# Оценка перцентилей приближённая (с точностью около 1%), поэтому она ограничивается точными минимумом
+# и максимумом окна - при постоянной нагрузке перцентили совпадают со значением.
+# Максимум считается точно по монотонной очереди: в ней хранятся только такты, значения которых больше
+# значений всех более поздних тактов окна, поэтому максимум окна - первый элемент, а добавление такта
+# стоит O(1) в среднем. Минимум - так же по второй очереди.
+# Значения показателей, которые суммируются за окно (io и net), - это объём за весь такт, поэтому для максимума
+# и перцентилей они делятся на длительность такта: пики сравниваются в пересчёте на один базовый интервал
+# Пиковые поля считаются только для показателей, которые суммируются или усредняются за окно
+class PeriodAggregator:
+    def __init__(self, period, fields=PERIOD_FIELDS):
+        self.period = period
+        self.fields = tuple(fields)
+        self.columns = tuple(field[0] for field in self.fields)
+        self._summed = [field for field in self.fields if field[3] in ("mean", "sum")]
+        self._weighted = [field[3] == "mean" for field in self._summed]
+        self._rates = [field[3] == "sum" for field in self._summed]
+        # Такты окна: (длительность, значения суммируемых полей)
+        self._window = deque()
+        self._elapsed = 0
+        self._sums = [0.0] * len(self._summed)
+        self._pushes = 0
+        positions = {(source, column): i for i, (_, source, column, _) in enumerate(self._summed)}
+        # Показатель -> (позиция значения такта в окне, оценка перцентилей, монотонные очереди
+        # (номер такта, значение) для максимума и минимума)
+        self._sketches = {
+            (source, column): (positions[source, column], QuantileSketch(), deque(), deque())
+            for _, source, column, kind in self.fields
+            if kind in PEAK_KINDS
+        }
+
+    # Вклад такта в суммы: для средних - значение, умноженное на длительность такта
+    def _contributions(self, elapsed, values):
+        return [value * elapsed if weighted else value for value, weighted in zip(values, self._weighted)]
+
+    # sources - статистика за текущий такт по источникам: {"general": ..., "client": ..., <метка цели>: ...},
+    # elapsed - длительность такта в базовых интервалах сбора
+    def push(self, sources, elapsed=1):
+        values = tuple(sources[source][column] for _, source, column, _ in self._summed)
+        self._window.append((elapsed, values))
+        self._elapsed += elapsed
+        for i, value in enumerate(self._contributions(elapsed, values)):
+            self._sums[i] += value
+        for i, sketch, maximums, minimums in self._sketches.values():
+            value = values[i] / elapsed if self._rates[i] else values[i]
+            sketch.add(value, elapsed)
+            while maximums and maximums[-1][1] <= value:
+                maximums.pop()
+            maximums.append((self._pushes, value))
+            while minimums and minimums[-1][1] >= value:
+                minimums.pop()
+            minimums.append((self._pushes, value))
+        while self._elapsed - self._window[0][0] >= self.period:
+            expired_elapsed, expired = self._window.popleft()
+            self._elapsed -= expired_elapsed
+            for i, value in enumerate(self._contributions(expired_elapsed, expired)):
+                self._sums[i] -= value
+            for i, sketch, _, _ in self._sketches.values():
+                sketch.add(expired[i] / expired_elapsed if self._rates[i] else expired[i], -expired_elapsed)
+        self._pushes += 1
+        # Номер первого такта окна: такты с меньшими номерами вышли из окна
+        first = self._pushes - len(self._window)
+        for _, _, maximums, minimums in self._sketches.values():
+            while maximums[0][0] < first:
+                maximums.popleft()
+            while minimums[0][0] < first:
+                minimums.popleft()
+        # Раз в period тактов суммы пересчитываются заново, чтобы ошибка округления от вычитаний не накапливалась.
+        # В пересчёте на один такт это остаётся O(1)
+        if self._pushes % self.period == 0:
+            self._sums = [sum(column) for column in zip(*(self._contributions(*tick) for tick in self._window))]
+
+        record = {}
+        sums = dict(zip((field[0] for field in self._summed), self._sums))
+        peaks = {}
+        for key, (_, sketch, maximums, minimums) in self._sketches.items():
+            maximum = maximums[0][1]
+            peaks[key] = {"max": maximum}
+            for kind, value in zip(PEAK_QUANTILES, sketch.quantiles(tuple(PEAK_QUANTILES.values()))):
+                peaks[key][kind] = min(max(value, minimums[0][1]), maximum)
+        for name, source, column, kind in self.fields:
+            if kind == "mean":
+                record[name] = sums[name] / self.period
+            elif kind == "sum":
+                record[name] = sums[name]
+            elif kind in PEAK_KINDS:
+                record[name] = peaks[source, column][kind]
+            else:
+                record[name] = sources[source][column]
+        return record
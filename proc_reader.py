@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+
+# Количество тиков процессора в секунде и размер страницы памяти для перевода значений из /proc
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# Размер буфера для чтения одного файла из /proc/<pid>/
+BUFFER_SIZE = 1024
+PROC_FILES = ("stat", "io", "statm")
+
+
+# Сбор статистики процессов напрямую из /proc/<pid>/stat, /proc/<pid>/io и /proc/<pid>/statm.
+# Файлы каждого процесса открываются один раз, а на каждом такте перечитываются с начала через preadv
+# в заранее выделенные буферы, без создания объектов psutil.Process.
+# Дескрипторы закрываются, когда процесс пропадает из списка отслеживаемых или завершается.
+# Если pid занят новым процессом, чтение по старому дескриптору завершается ошибкой ESRCH,
+# дескрипторы переоткрываются и значения читаются уже для нового процесса.
+class ProcReader:
+    def __init__(self, proc_path="/proc"):
+        if not os.path.isdir(proc_path):
+            raise OSError(f"{proc_path} недоступен")
+        self.proc_path = proc_path
+        # pid -> (дескрипторы файлов stat, io, statm; буферы для каждого файла)
+        self._handles = {}
+
+    def _open(self, pid):
+        fds = []
+        try:
+            for name in PROC_FILES:
+                fds.append(os.open(f"{self.proc_path}/{pid}/{name}", os.O_RDONLY | os.O_CLOEXEC))
+        except OSError:
+            for fd in fds:
+                os.close(fd)
+            raise
+        handle = (fds, [bytearray(BUFFER_SIZE) for _ in PROC_FILES])
+        self._handles[pid] = handle
+        return handle
+
+    def _close(self, pid):
+        for fd in self._handles.pop(pid)[0]:
+            os.close(fd)
+
+    def _read(self, pid):
+        handle = self._handles.get(pid)
+        if handle is None:
+            handle = self._open(pid)
+        try:
+            sizes = _pread_all(*handle)
+        except ProcessLookupError:
+            # Процесс завершился или pid переиспользован - переоткрываем файлы
+            self._close(pid)
+            handle = self._open(pid)
+            sizes = _pread_all(*handle)
+        stat, io, statm = handle[1]
+        stat_size, io_size, statm_size = sizes
+
+        # В /proc/<pid>/stat имя процесса в скобках может содержать пробелы, поэтому поля считаются
+        # от последней закрывающей скобки: utime и stime - 14 и 15 поля файла, starttime - 22 поле
+        fields = stat[stat.rindex(b")", 0, stat_size) + 2 : stat_size].split(None, 20)
+        start_time = int(fields[19])
+        cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        io_read = _io_field(io, io_size, b"\nread_bytes: ")
+        io_write = _io_field(io, io_size, b"\nwrite_bytes: ")
+        rss = int(statm[: statm_size].split(None, 2)[1]) * PAGE_SIZE
+        return start_time, cpu_time, io_read, io_write, rss
+
+    # Статистика одного процесса в тех же единицах, что и у get_clients_stats, вместе с временем запуска
+    # процесса, по которому отслеживается переиспользование pid. Если процесс завершился,
+    # его дескрипторы закрываются и выбрасывается исключение
+    def sample(self, proc_pid):
+        try:
+            start_time, cpu_time, io_read, io_write, rss = self._read(proc_pid)
+        except (OSError, ValueError, IndexError) as e:
+            self.forget(proc_pid)
+            raise ProcessLookupError(f"File /proc/{proc_pid}/stat doesn't exist") from e
+        return start_time, [cpu_time, io_read / 1024, io_write / 1024, rss / (1024 * 1024)]
+
+    # Закрытие дескрипторов процесса, который больше не отслеживается
+    def forget(self, proc_pid):
+        if proc_pid in self._handles:
+            self._close(proc_pid)
+
+    def close(self):
+        for pid in list(self._handles):
+            self._close(pid)
+
+
+# Чтение файлов процесса с начала в их буферы. Пустой файл означает, что процесс уже завершился
+def _pread_all(fds, buffers):
+    sizes = [os.preadv(fd, [buffer], 0) for fd, buffer in zip(fds, buffers)]
+    if not all(sizes):
+        raise ProcessLookupError
+    return sizes
+
+
+# Значение поля из /proc/<pid>/io. Поиск ведётся с символа перевода строки, чтобы не спутать
+# read_bytes с rchar/syscr и подобными полями
+def _io_field(buffer, size, name):
+    start = buffer.find(name, 0, size)
+    if start < 0:
+        # read_bytes может быть первой строкой файла
+        if buffer.startswith(name[1:]):
+            start = -1
+        else:
+            raise ValueError(f"Поле {name.strip().decode()} не найдено")
+    start += len(name)
+    return int(buffer[start : buffer.index(b"\n", start, size)])
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import psutil
+
+
+# Сбор статистики процесса через psutil. Объекты psutil.Process создаются один раз для каждого процесса
+# и переиспользуются на следующих тактах. Если pid занят новым процессом (is_running сравнивает
+# время запуска), объект создаётся заново. Возвращает время запуска процесса и статистику
+# [cpu, io_read, io_write, memory] в секундах, килобайтах и мегабайтах
+class PsutilSampler:
+    def __init__(self):
+        self._processes = {}
+
+    def sample(self, proc_pid):
+        try:
+            proc = self._processes.get(proc_pid)
+            if proc is None or not proc.is_running():
+                proc = self._processes[proc_pid] = psutil.Process(proc_pid)
+            with proc.oneshot():
+                cpu_times = proc.cpu_times()
+                io_counters = proc.io_counters()
+                memory_info = proc.memory_info()
+        except psutil.Error as e:
+            self.forget(proc_pid)
+            raise ProcessLookupError(f"File /proc/{proc_pid}/stat doesn't exist") from e
+        return proc.create_time(), [
+            cpu_times.user + cpu_times.system,
+            io_counters.read_bytes / 1024,
+            io_counters.write_bytes / 1024,
+            memory_info.rss / (1024 * 1024),
+        ]
+
+    def forget(self, proc_pid):
+        self._processes.pop(proc_pid, None)
+
+    def close(self):
+        self._processes.clear()
+
+
+# Отслеживание дерева процессов, порождённых процессами из roots, между тактами.
+# Для каждого процесса хранятся последние значения счётчиков вместе с его временем запуска,
+# то есть процесс определяется парой (pid, время запуска).
+# Когда процесс завершается или его pid переиспользуется, последние значения cpu и io
+# добавляются в накопитель reaped, поэтому суммы по дереву не уменьшаются, и дельты не становятся отрицательными.
+# Память завершившегося процесса не накапливается, так как это не счётчик.
+# Дочерние процессы находятся через /proc/<pid>/task/<tid>/children, то есть читаются только
+# файлы процессов из дерева, а не вся таблица процессов. Есть ли эти файлы, проверяется по первому
+# найденному корневому процессу (в proc_path, например /host/proc, pid самого сборщика может быть другим).
+# Если ядро не предоставляет этих файлов, используется psutil.Process.children(recursive=True).
+# После enable_breakdown для каждого процесса дерева дополнительно накапливается его потребление
+# между вызовами take_breakdown: дельты cpu и io по сравнению с прошлым тактом и последняя память.
+# Это стоит одного обращения к словарю на процесс за такт, а имя процесса читается один раз при его появлении
+class ProcessTree:
+    def __init__(self, roots, sampler, proc_path="/proc"):
+        # Корневые процессы дерева. Могут меняться между тактами, например при перезапуске процесса
+        self.roots = list(roots)
+        self.proc_path = proc_path
+        self._sampler = sampler
+        # pid -> (время запуска, [cpu, io_read, io_write, memory])
+        self._tracked = {}
+        # Накопленные cpu, io_read и io_write завершившихся процессов
+        self.reaped = [0.0, 0.0, 0.0]
+        # Есть ли файлы children: None, пока не найден ни один корневой процесс
+        self._children_files = None
+        # (pid, время запуска) -> [имя, cpu, io_read, io_write, memory] с последнего take_breakdown
+        self.breakdown = None
+        self._updated = False
+
+    def enable_breakdown(self):
+        self.breakdown = {}
+
+    # Потребление процессов с прошлого вызова. Учёт начинается заново
+    def take_breakdown(self):
+        breakdown, self.breakdown = self.breakdown, {}
+        return breakdown
+
+    def _name(self, pid):
+        try:
+            with open(f"{self.proc_path}/{pid}/comm") as comm:
+                return comm.read().strip()
+        except OSError:
+            return None
+
+    # Учёт дельт процесса за такт. Процесс, появившийся после первого такта, учитывается с нуля,
+    # так же как его значения попадают в суммы по дереву. На первом такте дельт ещё нет
+    def _account(self, pid, start_time, previous, values):
+        usage = self.breakdown.get((pid, start_time))
+        if usage is None:
+            usage = self.breakdown[pid, start_time] = [self._name(pid), 0.0, 0.0, 0.0, 0.0]
+        if previous is None:
+            previous = values if not self._updated else (0.0, 0.0, 0.0)
+        for i in range(3):
+            usage[i + 1] += values[i] - previous[i]
+        usage[4] = values[3]
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def __contains__(self, pid):
+        return pid in self._tracked
+
+    def _detect_children_files(self):
+        for root in self.roots:
+            task_path = f"{self.proc_path}/{root}/task/{root}"
+            if os.path.isdir(task_path):
+                return os.path.exists(f"{task_path}/children")
+        return None
+
+    def _discover(self):
+        if self._children_files is None:
+            self._children_files = self._detect_children_files()
+            if self._children_files is None:
+                return list(self.roots)
+        if not self._children_files:
+            pids = list(self.roots)
+            for root in self.roots:
+                try:
+                    pids.extend(child.pid for child in psutil.Process(root).children(recursive=True))
+                except psutil.Error:
+                    continue
+            return pids
+        # Корни могут оказаться потомками друг друга, поэтому уже найденные процессы пропускаются
+        pids = list(dict.fromkeys(self.roots))
+        found = set(pids)
+        for pid in pids:
+            task_path = f"{self.proc_path}/{pid}/task"
+            try:
+                for tid in os.listdir(task_path):
+                    with open(f"{task_path}/{tid}/children", "rb") as children:
+                        for child in map(int, children.read().split()):
+                            if child not in found:
+                                found.add(child)
+                                pids.append(child)
+            except OSError:
+                # Процесс или поток завершился во время обхода
+                continue
+        return pids
+
+    def _reap(self, pid):
+        _, values = self._tracked.pop(pid)
+        for i in range(3):
+            self.reaped[i] += values[i]
+
+    # Обход дерева на текущем такте. Возвращает суммы [cpu, io_read, io_write, memory] по живым процессам
+    # с учётом накопленных значений завершившихся процессов
+    def update(self):
+        totals = [0.0, 0.0, 0.0, 0.0]
+        alive = set()
+        for pid in self._discover():
+            if pid in alive:
+                continue
+            try:
+                start_time, values = self._sampler.sample(pid)
+            except OSError:
+                continue
+            tracked = self._tracked.get(pid)
+            if tracked is not None and tracked[0] != start_time:
+                self._reap(pid)
+                tracked = None
+            if self.breakdown is not None:
+                self._account(pid, start_time, tracked[1] if tracked is not None else None, values)
+            self._tracked[pid] = (start_time, values)
+            alive.add(pid)
+            for i in range(4):
+                totals[i] += values[i]
+        if len(self._tracked) > len(alive):
+            for pid in self._tracked.keys() - alive:
+                self._reap(pid)
+                self._sampler.forget(pid)
+        for i in range(3):
+            totals[i] += self.reaped[i]
+        self._updated = True
+        return totals
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import math
+import numpy as np
+
+
+# Потоковая оценка перцентилей с фиксированной памятью по логарифмическим корзинам (как в DDSketch).
+# Корзина i содержит значения из (gamma^(i-1), gamma^i], где gamma = (1 + a) / (1 - a), поэтому перцентиль
+# оценивается с относительной ошибкой не больше a = relative_accuracy. Значения меньше min_value
+# (в том числе нули) попадают в отдельную нулевую корзину, значения больше max_value - в последнюю корзину.
+# Количество корзин зависит только от точности и диапазона значений: при a = 1% и диапазоне от 1e-3 до 1e9 -
+# около 1400 целых счётчиков. Значения можно удалять (для скользящего окна), а оценки с одинаковыми
+# параметрами - складывать (для свёртки периодов в более длинные интервалы)
+class QuantileSketch:
+    def __init__(self, relative_accuracy=0.01, min_value=1e-3, max_value=1e9):
+        if not 0 < relative_accuracy < 1 or not 0 < min_value < max_value:
+            raise ValueError("точность должна быть от 0 до 1, а диапазон значений - положительным")
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        # Номер корзины min_value минус один: корзины значений начинаются с 1, корзина 0 - нулевая
+        self._offset = math.ceil(math.log(min_value) / self._log_gamma) - 1
+        self.counts = np.zeros(math.ceil(math.log(max_value) / self._log_gamma) - self._offset + 1, dtype=np.int64)
+        self.count = 0
+
+    def _index(self, value):
+        if value < self.min_value:
+            return 0
+        if value >= self.max_value:
+            return len(self.counts) - 1
+        return math.ceil(math.log(value) / self._log_gamma) - self._offset
+
+    def add(self, value, count=1):
+        self.counts[self._index(value)] += count
+        self.count += count
+
+    # Удаление ранее добавленного значения, например вышедшего из скользящего окна
+    def remove(self, value):
+        self.add(value, -1)
+
+    def merge(self, other):
+        if len(other.counts) != len(self.counts) or other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("складывать можно только оценки с одинаковыми точностью и диапазоном")
+        self.counts += other.counts
+        self.count += other.count
+
+    # Оценки перцентилей для списка долей quantiles (0.5 - медиана, 1.0 - максимум) за один проход по корзинам.
+    # Значение корзины - середина её диапазона в относительном смысле. Если значений нет, возвращаются nan
+    def quantiles(self, quantiles):
+        if self.count <= 0:
+            return [math.nan] * len(quantiles)
+        cumulative = np.cumsum(self.counts)
+        ranks = np.asarray(quantiles, dtype=np.float64) * (self.count - 1)
+        values = []
+        for index in np.searchsorted(cumulative, ranks, side="right").tolist():
+            if index == 0:
+                values.append(0.0)
+            else:
+                values.append(2 * self._gamma ** (index + self._offset) / (self._gamma + 1))
+        return values
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+# Первая строка файла с накопленными счётчиками
+RAW_MAGIC = b"TEST_MONITORING_RAW 1\n"
+
+
+# Тип записи файла: метка времени такта в миллисекундах epoch и значения счётчиков в float64
+def raw_dtype(columns):
+    return np.dtype([("timestamp", "<i8")] + [(column, "<f8") for column in columns])
+
+
+# Запись накопленных счётчиков за каждый такт в компактный двоичный файл.
+# Файл состоит из строки RAW_MAGIC, строки JSON с описанием записи (колонки и произвольные метаданные)
+# и записей фиксированного размера подряд. Записи накапливаются в заранее выделенном массиве numpy
+# и дописываются в файл пачками, как в stats_output.BatchedWriter
+class RawCountersWriter:
+    def __init__(self, path, columns, metadata, batch_size=64, flush_interval=1.0, fsync=False):
+        self.columns = tuple(columns)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._batch = np.zeros(batch_size, dtype=raw_dtype(self.columns))
+        self._count = 0
+        self._file = open(path, "wb")
+        self._file.write(RAW_MAGIC)
+        self._file.write(json.dumps({"columns": self.columns, **metadata}, ensure_ascii=False).encode() + b"\n")
+        self._last_flush = time.monotonic()
+
+    def write(self, timestamp, values):
+        record = self._batch[self._count]
+        record["timestamp"] = timestamp
+        for column in self.columns:
+            record[column] = values[column]
+        self._count += 1
+        if self._count == len(self._batch) or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._count:
+            self._file.write(self._batch[: self._count].tobytes())
+            self._count = 0
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+# Чтение файла с накопленными счётчиками. Возвращает метаданные и массив записей numpy (структурный тип
+# с колонкой timestamp и колонками счётчиков). Файл отображается в память, а оборванная
+# при аварийном завершении последняя запись не читается
+def read_raw_counters(path):
+    with open(path, "rb") as raw_file:
+        if raw_file.readline() != RAW_MAGIC:
+            raise ValueError(f"{path} не является файлом накопленных счётчиков")
+        metadata = json.loads(raw_file.readline())
+        offset = raw_file.tell()
+    dtype = raw_dtype(metadata["columns"])
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if not count:
+        return metadata, np.zeros(0, dtype=dtype)
+    return metadata, np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сведения о файле накопленных счётчиков monitoring_test.py --record")
+    parser.add_argument("path", help="файл с накопленными счётчиками")
+    args = parser.parse_args()
+
+    metadata, records = read_raw_counters(args.path)
+    print(json.dumps({name: value for name, value in metadata.items() if name != "columns"}, ensure_ascii=False))
+    print(f"Колонок: {len(metadata['columns'])}, тактов: {len(records)}")
+    if len(records):
+        print(f"С {records['timestamp'][0]} по {records['timestamp'][-1]} мс epoch")
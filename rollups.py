@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from quantile_sketch import QuantileSketch
+
+# Свёртки для длительного сбора: имя и длительность интервала свёртки в секундах
+ROLLUP_LEVELS = (("1m", 60), ("1h", 3600))
+# Перцентили для показателей с оценкой перцентилей (sketch_columns) и соответствующие им доли
+ROLLUP_QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+# Свёртка ежесекундной статистики в интервалы фиксированной длительности: для каждого показателя
+# считаются минимум, максимум, среднее и сумма за интервал. Среднее и перцентили взвешиваются
+# по длительности тактов (elapsed, в базовых интервалах сбора), которая хранится в записи интервала.
+# Текущий интервал накапливается в массивах numpy, поэтому добавление такта стоит O(количество показателей)
+# без выделения памяти.
+# Такт с меткой времени t попадает в интервал [t // resolution * resolution, ... + resolution).
+# Завершённые интервалы возвращаются из push, чтобы их можно было записать в файл и передать в свёртку
+# следующего уровня через merge.
+# Показатели из rate_columns - объёмы за такт (io и net): для минимума, максимума, среднего и перцентилей
+# они делятся на длительность такта, то есть сравниваются в пересчёте на один базовый интервал,
+# а сумма за интервал остаётся суммой объёмов.
+# Для показателей из sketch_columns значения тактов интервала собираются в QuantileSketch, по которым
+# считаются перцентили интервала. При merge оценки перцентилей складываются, поэтому перцентили
+# часового интервала считаются по всем его тактам, а не по перцентилям минут
+class Rollup:
+    def __init__(self, name, resolution_ms, columns, sketch_columns=(), rate_columns=()):
+        self.name = name
+        self.resolution_ms = resolution_ms
+        self.columns = tuple(columns)
+        self.sketch_columns = tuple(sketch_columns)
+        self.rate_columns = frozenset(rate_columns)
+        self._rate_mask = np.array([column in self.rate_columns for column in self.columns], dtype=bool)
+        self._sketches = self._new_sketches()
+        self._start = None
+        self._count = 0
+        self._min = np.empty(len(self.columns))
+        self._max = np.empty(len(self.columns))
+        self._sum = np.empty(len(self.columns))
+        self._weighted = np.empty(len(self.columns))
+        self._elapsed = 0
+
+    def _new_sketches(self):
+        return {column: QuantileSketch() for column in self.sketch_columns}
+
+    # Добавление статистики одного такта. values - словарь значений по показателям,
+    # elapsed - длительность такта в базовых интервалах сбора
+    def push(self, timestamp, values, elapsed=1):
+        row = np.fromiter((values[column] for column in self.columns), np.float64, len(self.columns))
+        normalized = np.where(self._rate_mask, row / elapsed, row)
+        finished = self._add(timestamp, normalized, normalized, row, normalized * elapsed, 1, elapsed)
+        for column, sketch in self._sketches.items():
+            sketch.add(values[column] / elapsed if column in self.rate_columns else values[column], elapsed)
+        return finished
+
+    # Добавление завершённого интервала свёртки меньшей длительности (вместе с её оценками перцентилей)
+    def merge(self, timestamp, bucket):
+        finished = self._add(
+            timestamp,
+            np.fromiter((bucket["min"][column] for column in self.columns), np.float64, len(self.columns)),
+            np.fromiter((bucket["max"][column] for column in self.columns), np.float64, len(self.columns)),
+            np.fromiter((bucket["sum"][column] for column in self.columns), np.float64, len(self.columns)),
+            np.fromiter((bucket["mean"][column] for column in self.columns), np.float64, len(self.columns))
+            * bucket["elapsed"],
+            bucket["count"],
+            bucket["elapsed"],
+        )
+        for column, sketch in self._sketches.items():
+            sketch.merge(bucket["sketches"][column])
+        return finished
+
+    def _add(self, timestamp, minimum, maximum, total, weighted, count, elapsed):
+        start = timestamp // self.resolution_ms * self.resolution_ms
+        finished = None
+        if self._start is not None and start != self._start:
+            finished = self.flush()
+        if not self._count:
+            self._start = start
+            self._min[:] = minimum
+            self._max[:] = maximum
+            self._sum[:] = total
+            self._weighted[:] = weighted
+        else:
+            np.minimum(self._min, minimum, out=self._min)
+            np.maximum(self._max, maximum, out=self._max)
+            self._sum += total
+            self._weighted += weighted
+        self._count += count
+        self._elapsed += elapsed
+        return finished
+
+    # Завершение текущего интервала, в том числе неполного (например, при остановке сбора).
+    # Возвращает метку начала интервала и запись интервала или None, если тактов в интервале не было.
+    # Оценки перцентилей интервала передаются в записи под ключом sketches для merge следующего уровня
+    def flush(self):
+        if not self._count:
+            return None
+        bucket = {
+            "count": self._count,
+            "elapsed": self._elapsed,
+            "min": dict(zip(self.columns, self._min.tolist())),
+            "max": dict(zip(self.columns, self._max.tolist())),
+            "mean": dict(zip(self.columns, (self._weighted / self._elapsed).tolist())),
+            "sum": dict(zip(self.columns, self._sum.tolist())),
+        }
+        for kind in ROLLUP_QUANTILES:
+            bucket[kind] = {}
+        # Оценки перцентилей приближённые, поэтому ограничиваются точными минимумом и максимумом интервала
+        for column, sketch in self._sketches.items():
+            for kind, value in zip(ROLLUP_QUANTILES, sketch.quantiles(tuple(ROLLUP_QUANTILES.values()))):
+                bucket[kind][column] = min(max(value, bucket["min"][column]), bucket["max"][column])
+        bucket["sketches"] = self._sketches
+        self._sketches = self._new_sketches()
+        self._count = 0
+        self._elapsed = 0
+        return self._start, bucket
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+
+
+# Планировщик сбора статистики по дедлайнам на монотонных часах.
+# Время каждого такта вычисляется от момента старта, а не от окончания предыдущего сбора,
+# поэтому время сбора не накапливается и такты не дрейфуют относительно файлов мониторинга RuBackup.
+# Такты выравниваются по границам интервала в реальном времени (при интервале 1 секунда - по началу секунды),
+# а wait возвращает номинальную метку времени такта в миллисекундах epoch, которая не зависит от задержки.
+# Если сбор занял больше интервала, пропущенные такты не догоняются, а учитываются в счётчике missed.
+# stride - через сколько интервалов выполняется следующий такт (для адаптивной частоты сбора). Такты
+# с шагом stride выравниваются по границам stride * interval_ms в реальном времени
+class TickScheduler:
+    def __init__(self, interval_ms, clock=time.monotonic, wall_clock=time.time, sleep=time.sleep):
+        if interval_ms <= 0:
+            raise ValueError("Интервал должен быть больше 0")
+        self.interval_ms = interval_ms
+        self._clock = clock
+        self._sleep = sleep
+        start_wall_ms = wall_clock() * 1000
+        start_clock = clock()
+        # Первый такт - ближайшая граница интервала в реальном времени
+        self._first_wall_ms = -(-int(start_wall_ms) // interval_ms) * interval_ms
+        self._first_deadline = start_clock + (self._first_wall_ms - start_wall_ms) / 1000
+        self._tick = 0
+        self.stride = 1
+        # Статистика по тактам: опоздание последнего такта в секундах, максимальное и суммарное опоздание,
+        # количество выполненных и пропущенных тактов
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.ticks = 0
+        self.missed = 0
+
+    # Метка времени следующего такта в миллисекундах epoch
+    def next_timestamp(self):
+        return self._first_wall_ms + self._tick * self.interval_ms
+
+    # Смена шага между тактами. Следующий такт переносится на ближайшую границу нового шага
+    def set_stride(self, stride):
+        self.stride = stride
+        step_ms = stride * self.interval_ms
+        self._tick = (-(-self.next_timestamp() // step_ms) * step_ms - self._first_wall_ms) // self.interval_ms
+
+    # Время в секундах до дедлайна следующего такта (0, если дедлайн уже наступил)
+    def delay(self):
+        return max(0.0, self._first_deadline + self._tick * self.interval_ms / 1000 - self._clock())
+
+    # Учёт наступившего такта: опоздание и пропущенные такты. Возвращает номинальную метку времени такта
+    def tick(self):
+        interval = self.interval_ms / 1000
+        step = interval * self.stride
+        deadline = self._first_deadline + self._tick * interval
+        now = self._clock()
+        if now - deadline >= step:
+            # Дедлайн одного или нескольких тактов уже прошёл - переходим к последнему наступившему такту
+            skipped = int((now - deadline) // step)
+            self._tick += skipped * self.stride
+            self.missed += skipped
+            deadline += skipped * step
+        self.lateness = max(0.0, now - deadline)
+        self.max_lateness = max(self.max_lateness, self.lateness)
+        self.total_lateness += self.lateness
+        self.ticks += 1
+        timestamp = self.next_timestamp()
+        self._tick += self.stride
+        return timestamp
+
+    def wait(self):
+        delay = self.delay()
+        if delay > 0:
+            self._sleep(delay)
+        return self.tick()
+
+    # Ожидание такта внутри цикла событий asyncio
+    async def wait_async(self):
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.tick()
+
+
+# Адаптивный шаг между тактами: при активности (busy) сбор сразу возвращается к самому частому шагу,
+# а после idle_ticks подряд тактов без активности шаг увеличивается до следующего из strides
+class AdaptiveStride:
+    def __init__(self, strides, idle_ticks=5):
+        self.strides = sorted(strides)
+        self.idle_ticks = idle_ticks
+        self._level = 0
+        self._idle = 0
+
+    @property
+    def stride(self):
+        return self.strides[self._level]
+
+    # Учёт такта. Возвращает шаг до следующего такта
+    def update(self, busy):
+        if busy:
+            self._level = 0
+            self._idle = 0
+        else:
+            self._idle += 1
+            if self._idle >= self.idle_ticks and self._level < len(self.strides) - 1:
+                self._level += 1
+                self._idle = 0
+        return self.stride
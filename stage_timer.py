@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import time
+from contextlib import contextmanager
+
+
+# Замер времени этапов сбора (общесистемная статистика, цели, подсчёт, файлы мониторинга и т.д.).
+# Для каждого этапа накапливаются количество замеров, суммарное и максимальное время, а в last -
+# время последнего замера. hook(stage, seconds) вызывается после каждого замера, через него время этапов
+# можно передать во внешний профилировщик. Этапы могут замеряться одновременно из разных потоков,
+# но один этап - только из одного потока
+class StageTimer:
+    def __init__(self, hook=None, clock=time.perf_counter):
+        self.hook = hook
+        self._clock = clock
+        # этап -> [количество, суммарное время, максимальное время]
+        self.stages = {}
+        self.last = {}
+
+    def record(self, stage, seconds):
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+        self.last[stage] = seconds
+        if self.hook is not None:
+            self.hook(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(stage, self._clock() - start)
+
+    # Обёртка над функцией, которая замеряет каждый её вызов как этап stage
+    def wrap(self, stage, function):
+        def timed(*args):
+            with self.stage(stage):
+                return function(*args)
+
+        return timed
+
+    # Сводка по этапам: строка на этап со средним и максимальным временем в миллисекундах
+    def summary(self):
+        return [
+            f"{stage}: {count} раз, среднее {total / count * 1000:.3f} мс, максимальное {maximum * 1000:.3f} мс, "
+            f"всего {total:.3f} с"
+            for stage, (count, total, maximum) in self.stages.items()
+        ]
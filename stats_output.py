@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+# Запись результатов в файл только дописыванием, пачками.
+# Записи накапливаются в памяти и сбрасываются в файл, когда их набралось batch_size
+# или с прошлого сброса прошло flush_interval секунд. При fsync=True после сброса вызывается os.fsync,
+# чтобы данные пережили перезагрузку. Записи бывают нескольких видов: "sample" - статистика за такт,
+# "period" - статистика за период вместе с данными из файла мониторинга, "top" - процессы целей
+# с наибольшим потреблением за период и "rollup" - минутный или часовой интервал свёртки.
+# Если задан max_bytes, файл ротируется при сбросе, когда его размер достиг max_bytes: path переименовывается
+# в path.1, path.1 - в path.2 и так далее, хранится не больше backups старых файлов. Поэтому при длительном
+# сборе файлы занимают не больше max_bytes * (backups + 1) с точностью до одной пачки записей
+class BatchedWriter:
+    def __init__(self, path, batch_size=64, flush_interval=1.0, fsync=False, mode="a", max_bytes=0, backups=0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._mode = mode
+        self._file = open(path, mode, encoding="utf-8")
+        self._batch = []
+        self._last_flush = time.monotonic()
+
+    def _format(self, kind, timestamp, record):
+        raise NotImplementedError
+
+    def write(self, kind, timestamp, record):
+        text = self._format(kind, timestamp, record)
+        if text:
+            self._batch.append(text)
+        if len(self._batch) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._file.write("".join(self._batch))
+            self._batch.clear()
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, self._mode, encoding="utf-8")
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+# Текстовый файл statistics в прежнем формате: ключ, строки "показатель значение" и разделитель.
+# Записываются только записи за период
+class StatisticsWriter(BatchedWriter):
+    def __init__(self, path="statistics", batch_size=64, flush_interval=1.0, fsync=False, max_bytes=0, backups=0):
+        super().__init__(path, batch_size, flush_interval, fsync, "w", max_bytes, backups)
+
+    def _format(self, kind, timestamp, record):
+        if kind != "period":
+            return None
+        lines = [f"{record['key']}\n"]
+        lines.extend(f"{stat_name} {stat_value}\n" for stat_name, stat_value in record["stats"].items())
+        lines.append("---------\n")
+        return "".join(lines)
+
+
+# Файл JSON Lines: одна запись на строку, {"type": ..., "timestamp": ..., ...}.
+# Файл открывается на дописывание, поэтому несколько запусков сохраняются в одном файле,
+# а оборванная при аварийном завершении последняя строка пропускается при чтении
+class JsonlWriter(BatchedWriter):
+    def _format(self, kind, timestamp, record):
+        return json.dumps({"type": kind, "timestamp": timestamp, **record}, ensure_ascii=False) + "\n"
+
+
+# Чтение записей из файла JSON Lines начиная с позиции offset (в байтах).
+# Вместе с каждой записью возвращается позиция сразу после неё, по которой чтение можно продолжить позже.
+# Незаконченная последняя строка не читается - её дописывание ещё не завершено
+def read_records(path, offset=0):
+    with open(path, "rb") as records_file:
+        records_file.seek(offset)
+        for line in records_file:
+            if not line.endswith(b"\n"):
+                return
+            offset += len(line)
+            yield json.loads(line), offset
+
+
+# Чтение записей с продолжением: после конца файла ожидается появление новых записей, как в tail -f
+def tail_records(path, offset=0, poll_interval=1.0):
+    while True:
+        for record, offset in read_records(path, offset):
+            yield record, offset
+        time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Чтение файла JSON Lines, записанного monitoring_test.py --output")
+    parser.add_argument("path", help="файл с записями")
+    parser.add_argument("--offset", type=int, default=0, help="позиция в байтах, с которой продолжить чтение")
+    parser.add_argument(
+        "--type", choices=("sample", "period", "top", "rollup"), help="выводить только записи этого вида"
+    )
+    parser.add_argument("--follow", action="store_true", help="ожидать новые записи после конца файла")
+    args = parser.parse_args()
+
+    offset = args.offset
+    records = tail_records(args.path, offset) if args.follow else read_records(args.path, offset)
+    try:
+        for record, offset in records:
+            if args.type is None or record["type"] == args.type:
+                print(json.dumps(record, ensure_ascii=False))
+    except KeyboardInterrupt:
+        pass
+    # Позиция для продолжения чтения выводится в stderr, чтобы не смешиваться с записями
+    print(f"offset {offset}", file=sys.stderr)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+# Колоночное хранилище ежесекундной статистики фиксированного размера (кольцевой буфер).
+# Для каждого показателя заранее выделяется отдельный массив numpy на capacity записей,
+# а метки времени хранятся как целые миллисекунды epoch. Добавление записи и доступ к предыдущей записи
+# выполняются за O(1), при переполнении самые старые записи перезаписываются.
+class StatsStore:
+    def __init__(self, columns, capacity):
+        if capacity < 1:
+            raise ValueError("capacity должен быть больше 0")
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self._data = {column: np.zeros(capacity, dtype=np.float64) for column in self.columns}
+        # Общее количество добавленных записей, включая уже перезаписанные
+        self.total = 0
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    # Перевод логического индекса (0 - самая старая из хранимых записей, -1 - последняя)
+    # в индекс ячейки кольцевого буфера
+    def _slot(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("индекс за пределами хранилища")
+        return (self.total - length + index) % self.capacity
+
+    def append(self, timestamp, values):
+        slot = self.total % self.capacity
+        self.timestamps[slot] = timestamp
+        for column in self.columns:
+            self._data[column][slot] = values[column]
+        self.total += 1
+
+    # Добавление сразу нескольких записей: values - словарь массивов значений по колонкам.
+    # Если записей больше, чем capacity, в хранилище остаются только последние capacity записей
+    def extend(self, timestamps, values):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        count = len(timestamps)
+        skip = max(0, count - self.capacity)
+        slots = (self.total + skip + np.arange(count - skip)) % self.capacity
+        self.timestamps[slots] = timestamps[skip:]
+        for column in self.columns:
+            self._data[column][slots] = np.asarray(values[column], dtype=np.float64)[skip:]
+        self.total += count
+
+    def get(self, column, index=-1):
+        return float(self._data[column][self._slot(index)])
+
+    def timestamp(self, index=-1):
+        return int(self.timestamps[self._slot(index)])
+
+    def row(self, index=-1):
+        slot = self._slot(index)
+        return {column: float(self._data[column][slot]) for column in self.columns}
+
+    # Количество записей с меткой времени не больше timestamp, двоичным поиском за O(log n).
+    # Метки времени в хранилище не убывают
+    def _bisect(self, timestamp):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[self._slot(middle)] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Поиск логического индекса последней записи с указанной меткой времени. Если записи нет, возвращается None
+    def find(self, timestamp):
+        low = self._bisect(timestamp)
+        if low and self.timestamps[self._slot(low - 1)] == timestamp:
+            return low - 1
+        return None
+
+    # Значения всех показателей в момент timestamp, линейно интерполированные между соседними записями,
+    # за O(log n). Если момент вне диапазона хранимых записей, возвращается None
+    def interpolate(self, timestamp):
+        index = self._bisect(timestamp)
+        if not index or (index == len(self) and timestamp > self.timestamp()):
+            return None
+        before = self._slot(index - 1)
+        if self.timestamps[before] == timestamp:
+            return self.row(index - 1)
+        after = self._slot(index)
+        weight = (timestamp - self.timestamps[before]) / (self.timestamps[after] - self.timestamps[before])
+        return {
+            column: float(values[before] + (values[after] - values[before]) * weight)
+            for column, values in self._data.items()
+        }
+
+    # То же для массива моментов: словарь массивов значений, nan для моментов вне диапазона хранимых записей
+    def interpolate_many(self, timestamps):
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if not len(self):
+            return {column: np.full(timestamps.shape, np.nan) for column in self.columns}
+        times = self.timestamps_range()
+        return {
+            column: np.interp(timestamps, times, self.column(column), left=np.nan, right=np.nan)
+            for column in self.columns
+        }
+
+    # Значения показателя за логический диапазон [start, end) в хронологическом порядке.
+    # Если диапазон не пересекает границу буфера, возвращается срез без копирования
+    def column(self, column, start=0, end=None):
+        return self._range(self._data[column], start, end)
+
+    def timestamps_range(self, start=0, end=None):
+        return self._range(self.timestamps, start, end)
+
+    def _range(self, array, start, end):
+        length = len(self)
+        if end is None:
+            end = length
+        start = max(0, start)
+        end = min(end, length)
+        if start >= end:
+            return array[:0]
+        first = (self.total - length + start) % self.capacity
+        count = end - start
+        if first + count <= self.capacity:
+            return array[first : first + count]
+        return np.concatenate((array[first:], array[: first + count - self.capacity]))
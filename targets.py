@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import psutil
+from process_tree import ProcessTree
+
+TARGET_KINDS = ("name", "pidfile", "cgroup")
+# Метка цели используется в именах полей файла statistics (psutil_<метка>_cpu и т.д.)
+TARGET_LABEL_PATTERN = re.compile(r"^[a-z][a-z0-9_]*$")
+# Длина имени процесса в /proc/<pid>/comm, до которой ядро обрезает имя
+COMM_LENGTH = 15
+
+
+# Разбор описания цели вида "метка=тип:значение", например "server=name:rubackup_server",
+# "client=pidfile:/var/run/rubackup_client.pid" или "db=cgroup:/sys/fs/cgroup/system.slice/postgresql.service"
+def parse_target(spec):
+    label, _, target = spec.partition("=")
+    kind, _, value = target.partition(":")
+    if not TARGET_LABEL_PATTERN.match(label) or kind not in TARGET_KINDS or not value:
+        raise ValueError(
+            f"Неверное описание цели {spec!r}: ожидается метка=тип:значение, "
+            f"метка из строчных латинских букв, цифр и _, тип - один из {', '.join(TARGET_KINDS)}"
+        )
+    return label, kind, value
+
+
+# Поиск процессов по подстроке в имени через /proc/<pid>/comm: на процесс приходится одно короткое чтение
+# вместо создания объекта psutil.Process и разбора его stat. Если имя в comm обрезано ядром и подстрока
+# в нём не найдена, полное имя берётся у psutil (он дополняет его из cmdline), - таких процессов немного
+def find_processes_by_name(value, proc_path="/proc"):
+    pids = []
+    for entry in os.scandir(proc_path):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"{proc_path}/{entry.name}/comm", "rb") as comm:
+                name = comm.read().rstrip(b"\n").decode(errors="replace")
+            if value not in name and len(name) >= COMM_LENGTH:
+                name = psutil.Process(int(entry.name)).name()
+        except (OSError, psutil.Error):
+            # Процесс завершился во время поиска
+            continue
+        if value in name:
+            pids.append(int(entry.name))
+    return pids
+
+
+# Отслеживаемая цель: набор корневых процессов и все их дочерние процессы.
+# Корневые процессы находятся по подстроке в имени процесса (как раньше искался rubackup_client, но через
+# find_processes_by_name), по pid-файлу или по списку процессов cgroup. pid-файл и cgroup.procs перечитываются
+# на каждом такте, это дешёвое чтение одного файла. Поиск по имени требует обхода всех процессов, поэтому он повторяется
+# только когда корневой процесс завершился (например, при перезапуске) или цель не найдена,
+# и не чаще, чем раз в rediscover_ticks тактов.
+# Накопленные значения завершившихся процессов сохраняются при перезапуске, поэтому дельты остаются корректными.
+class Target:
+    def __init__(self, label, kind, value, sampler, rediscover_ticks=5, proc_path="/proc"):
+        self.label = label
+        self.kind = kind
+        self.value = value
+        self.rediscover_ticks = rediscover_ticks
+        self._sampler = sampler
+        self.proc_path = proc_path
+        self._ticks_since_resolve = rediscover_ticks
+        self.tree = ProcessTree([], sampler, proc_path)
+        self.tree.roots = self._resolve()
+
+    def _resolve(self):
+        self._ticks_since_resolve = 0
+        try:
+            if self.kind == "name":
+                return find_processes_by_name(self.value, self.proc_path)
+            if self.kind == "pidfile":
+                with open(self.value) as pidfile:
+                    return [int(pidfile.read().split()[0])]
+            with open(f"{self.value}/cgroup.procs") as cgroup_procs:
+                return [int(pid) for pid in cgroup_procs.read().split()]
+        except (OSError, ValueError, IndexError):
+            return []
+
+    # Суммы [cpu, io_read, io_write, memory] по процессам цели на текущем такте
+    def update(self):
+        self._ticks_since_resolve += 1
+        if self.kind != "name":
+            self.tree.roots = self._resolve()
+        elif self._ticks_since_resolve >= self.rediscover_ticks and (
+            not self.tree.roots or not all(root in self.tree for root in self.tree.roots)
+        ):
+            self.tree.roots = self._resolve()
+        return self.tree.update()
+
+    def close(self):
+        self._sampler.close()